@@ -0,0 +1,434 @@
+"""
+隐患整改台账与报告生成工具的性能基准测试
+
+按模板列布局生成指定规模的合成台账和对应的图片压缩包（JPEG、PNG、HEIC 按比例混合，分辨率接近手机拍摄和截图），
+分别测量 embed_images_to_excel、generate_check_report 和 generate_closure_report 的耗时、吞吐量（行/秒、图片/秒）
+和峰值内存，结果输出为 JSON；指定 --baseline 时与保存的基准结果比较，超出容差视为性能回退并以非零状态退出
+
+    python 性能基准测试.py --rows 500 --output 基准结果.json
+    python 性能基准测试.py --rows 500 --baseline 基准结果.json --tolerance 0.2
+
+每项测量在独立的子进程中运行，峰值内存互不影响；转码不使用缩略图缓存，测得的是冷启动性能
+"""
+import os
+import io
+import sys
+import json
+import time
+import random
+import struct
+import zipfile
+import tempfile
+import argparse
+import platform
+import traceback
+import multiprocessing
+from datetime import datetime, timedelta
+
+import 隐患整改台账与报告生成工具 as tool
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LEDGER_TEMPLATE = os.path.join(BASE_DIR, "安全生产管理_隐患整改通知单_隐患整改台账模板.xlsx")
+CHECK_TEMPLATE = os.path.join(BASE_DIR, "检查报告模板.docx")
+CLOSURE_TEMPLATE = os.path.join(BASE_DIR, "闭环报告模板.docx")
+
+# 合成图片的格式：(格式, 宽, 高, 文件扩展名, 细节噪声比例)，按 --mix 中的权重随机选择
+# 噪声比例使文件大小接近实拍：4000x3000 的 JPEG 约 2.5 MB，截图没有噪声
+SYNTHETIC_FORMATS = {
+    "jpeg": ("JPEG", 4000, 3000, ".jpg", 0.06),        # 手机相机原图
+    "jpeg_small": ("JPEG", 1920, 1440, ".jpg", 0.06),  # 聊天软件压缩后的照片
+    "png": ("PNG", 1080, 2340, ".png", 0.0),           # 手机截图
+    "heic": ("HEIF", 4032, 3024, ".heic", 0.04),       # iPhone 原图
+}
+# HEIC 编码很慢（单张 4032x3024 约 7 秒），只编码几种底图，每张图片末尾追加内容不同的 free 盒子区分
+HEIC_VARIANTS = 3
+# 与 iPhone 原图一样内嵌 320 像素的缩略图（快速缩放模式下输出尺寸不超过缩略图时直接解码缩略图）
+HEIC_THUMBNAIL_BOXES = [320]
+# 合成数据的生成方式改变时递增，工作目录中旧版本的数据集不再复用
+DATASET_VERSION = 2
+DEFAULT_MIX = "jpeg=0.45,jpeg_small=0.2,png=0.1,heic=0.25"
+
+HAZARD_PHOTO_RATE = 0.95   # 有隐患照片的行比例
+CLOSED_RATE = 0.7          # 已闭环（有闭环照片）的行比例
+
+SYNTHETIC_CATEGORIES = ["设备设施", "消防安全", "用电安全", "作业行为", "环境保护"]
+SYNTHETIC_ITEMS = ["配电箱未上锁", "灭火器压力不足", "安全通道堆放杂物", "防护栏松动", "未按规定佩戴安全帽",
+                   "危废暂存间标识缺失", "电缆绝缘层破损", "应急照明不亮", "油品泄漏未及时清理", "登高作业未系安全带"]
+SYNTHETIC_TEAMS = [f"{n}班组" for n in "一二三四五六七八"]
+SYNTHETIC_NAMES = ["张伟", "王芳", "李强", "刘洋", "陈静", "杨磊", "赵敏", "黄涛"]
+
+BENCH_TASKS = ("embed_images_to_excel", "generate_check_report", "generate_closure_report")
+
+def parse_mix(text):
+    """解析 "jpeg=0.45,png=0.1" 形式的格式比例，返回 {格式: 权重}"""
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in SYNTHETIC_FORMATS:
+            raise ValueError(f"未知的图片格式: {name}，可选 {', '.join(SYNTHETIC_FORMATS)}")
+        mix[name] = float(weight)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError(f"图片格式比例无效: {text}")
+    return mix
+
+def _heif_available():
+    try:
+        import pillow_heif  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _base_texture(width, height, noise_alpha, rng):
+    """
+    生成接近实拍照片压缩率的底图：低分辨率色块放大得到平滑的明暗变化，再按比例叠加固定种子的细节噪声
+    """
+    PILImage = tool._pil()
+    coarse = PILImage.frombytes("RGB", (16, 12), rng.randbytes(16 * 12 * 3))
+    base = coarse.resize((width, height), PILImage.BICUBIC)
+    if not noise_alpha:
+        return base
+    tile_size = 256
+    tile = PILImage.frombytes("L", (tile_size, tile_size), rng.randbytes(tile_size * tile_size))
+    noise = PILImage.new("L", (width, height))
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            noise.paste(tile, (x, y))
+    return PILImage.blend(base, PILImage.merge("RGB", (noise, noise, noise)), noise_alpha)
+
+def make_synthetic_dataset(rows, work_dir, seed=1, mix=DEFAULT_MIX):
+    """
+    生成合成台账和图片压缩包，返回数据集信息字典（路径、行数、各文件夹图片数、各格式图片数）
+    相同参数的数据集已存在时直接复用
+    """
+    name = f"synthetic_v{DATASET_VERSION}_{rows}_{seed}_" + "_".join(f"{k}{v:g}" for k, v in sorted(parse_mix(mix).items()))
+    info_path = os.path.join(work_dir, name + ".json")
+    if os.path.exists(info_path):
+        with open(info_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    os.makedirs(work_dir, exist_ok=True)
+    rng = random.Random(seed)
+    weights = parse_mix(mix)
+    if "heic" in weights and not _heif_available():
+        print("警告: 未安装 pillow_heif，HEIC 图片改为 JPEG")
+    formats = list(weights)
+
+    records = []
+    start = datetime(2024, 1, 1, 8, 0)
+    for n in range(1, rows + 1):
+        found = start + timedelta(hours=rng.randrange(0, 24 * 365))
+        closed = rng.random() < CLOSED_RATE
+        records.append({
+            "隐患编号": f"BM{n:05d}",
+            "异常事项": rng.choice(SYNTHETIC_ITEMS),
+            "异常类别": rng.choice(SYNTHETIC_CATEGORIES),
+            "隐患级别": "重大隐患" if rng.random() < 0.05 else "一般隐患",
+            "检查类别": rng.choice(["日常检查", "专项检查", "节假日检查"]),
+            "发现人": rng.choice(SYNTHETIC_NAMES),
+            "厂区": rng.choice(["一厂区", "二厂区"]),
+            "班组": rng.choice(SYNTHETIC_TEAMS),
+            "整改人": rng.choice(SYNTHETIC_NAMES),
+            "发现时间": found,
+            "要求闭环时间": (found + timedelta(days=rng.randrange(1, 15))).replace(hour=0, minute=0),
+            "实际闭环时间": found + timedelta(hours=rng.randrange(2, 200)) if closed else None,
+            "闭环情况": "已闭环" if closed else "未闭环",
+            "月份": found.month,
+            "季度": (found.month - 1) // 3 + 1,
+            "年度": found.year,
+            "photos": {"隐患照片": rng.random() < HAZARD_PHOTO_RATE, "闭环照片": closed},
+        })
+
+    excel_path = os.path.join(work_dir, name + ".xlsx")
+    _write_synthetic_ledger(records, excel_path)
+
+    zip_path = os.path.join(work_dir, name + ".zip")
+    textures = {}
+    heic_variants = []
+    counts = {"隐患照片": 0, "闭环照片": 0}
+    format_counts = {}
+    from PIL import ImageDraw
+
+    def encode(fmt):
+        """以该格式的底图画上位置和颜色随机的色块后编码，保证每张图片内容不同，不会被按内容去重"""
+        pil_format, width, height, ext, noise_alpha = SYNTHETIC_FORMATS[fmt]
+        if fmt not in textures:
+            textures[fmt] = _base_texture(width, height, noise_alpha, rng)
+        img = textures[fmt].copy()
+        x, y = rng.randrange(0, width - 400), rng.randrange(0, height - 400)
+        ImageDraw.Draw(img).rectangle((x, y, x + 400, y + 400), fill=tuple(rng.randbytes(3)))
+        buffer = io.BytesIO()
+        if pil_format == "JPEG":
+            img.save(buffer, "JPEG", quality=90)
+        elif pil_format == "HEIF":
+            img.save(buffer, "HEIF", enc_params={"preset": "ultrafast"}, thumbnails=HEIC_THUMBNAIL_BOXES)
+        else:
+            img.save(buffer, pil_format)
+        return buffer.getvalue()
+
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf:
+        for record in records:
+            for folder, present in record["photos"].items():
+                if not present:
+                    continue
+                fmt = rng.choices(formats, [weights[f] for f in formats])[0]
+                if fmt == "heic" and not _heif_available():
+                    fmt = "jpeg"
+                key = record["隐患编号"]
+                if fmt == "heic":
+                    if len(heic_variants) < HEIC_VARIANTS:
+                        heic_variants.append(encode(fmt))
+                    payload = f"{folder}/{key}".encode("utf-8")
+                    data = rng.choice(heic_variants) + struct.pack(">I4s", 8 + len(payload), b"free") + payload
+                else:
+                    data = encode(fmt)
+                zf.writestr(f"{folder}/{key}{SYNTHETIC_FORMATS[fmt][3]}", data)
+                counts[folder] += 1
+                format_counts[fmt] = format_counts.get(fmt, 0) + 1
+
+    info = {
+        "name": name,
+        "excel": excel_path,
+        "zip": zip_path,
+        "rows": rows,
+        "seed": seed,
+        "mix": mix,
+        "photos": counts,
+        "formats": format_counts,
+        "zip_mb": round(os.path.getsize(zip_path) / 1024 / 1024, 1),
+    }
+    with open(info_path, "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+def _write_synthetic_ledger(records, excel_path):
+    """按台账模板的列布局写入合成数据，超出模板预置格式的行沿用第 2 行的单元格格式和行高"""
+    from copy import copy
+    from openpyxl import load_workbook
+
+    wb = load_workbook(LEDGER_TEMPLATE)
+    ws = wb.active
+    columns = {cell.value: cell.column for cell in ws[1] if cell.value}
+    prototype = {cell.column: cell for cell in ws[2]}
+    row_height = ws.row_dimensions[2].height
+    template_rows = ws.max_row
+    for row_idx, record in enumerate(records, start=2):
+        if row_idx > template_rows:
+            for col, cell in prototype.items():
+                if cell.has_style:
+                    ws.cell(row=row_idx, column=col)._style = copy(cell._style)
+            ws.row_dimensions[row_idx].height = row_height
+        for header, value in record.items():
+            if header in columns and value is not None:
+                ws.cell(row=row_idx, column=columns[header], value=value)
+    wb.save(excel_path)
+
+def _peak_memory():
+    """
+    返回 (本进程峰值内存 MB, 测量方式)
+    Linux 读取 /proc 的 VmHWM，其他 Unix 用 resource，Windows 用 psutil，都不可用时退回 tracemalloc（只统计 Python 分配）
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024, "VmHWM"
+    except OSError:
+        pass
+    try:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS 单位为字节，其他系统为 KB
+        return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024), "ru_maxrss"
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024 / 1024, "psutil"
+    except ImportError:
+        pass
+    import tracemalloc
+    return tracemalloc.get_traced_memory()[1] / 1024 / 1024, "tracemalloc"
+
+def _children_peak_memory():
+    """返回已结束的转码子进程中最大的峰值内存（MB），无法测量时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def _measure_task(task, info, out_dir, options, result_queue):
+    """子进程入口：运行一项生成任务，回传耗时和峰值内存"""
+    import tracemalloc
+    try:
+        import resource  # noqa: F401
+    except ImportError:
+        try:
+            import psutil  # noqa: F401
+        except ImportError:
+            tracemalloc.start()
+    try:
+        kwargs = dict(workers=options["workers"], cache=False, resample=options["resample"], profile=options["profile"])
+        if task == "embed_images_to_excel":
+            output_path = os.path.join(out_dir, "台账_带图片.xlsx")
+            start = time.perf_counter()
+            tool.embed_images_to_excel(info["excel"], info["zip"], output_path, streaming=options["streaming"], **kwargs)
+        else:
+            template = CHECK_TEMPLATE if task == "generate_check_report" else CLOSURE_TEMPLATE
+            output_path = os.path.join(out_dir, os.path.basename(template))
+            start = time.perf_counter()
+            getattr(tool, task)(info["excel"], template, info["zip"], output_path, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_mb, method = _peak_memory()
+        result_queue.put({
+            "seconds": seconds,
+            "peak_mb": peak_mb,
+            "children_peak_mb": _children_peak_memory(),
+            "memory_method": method,
+            "output_mb": os.path.getsize(output_path) / 1024 / 1024,
+        })
+    except BaseException:
+        result_queue.put({"error": traceback.format_exc()})
+
+def task_photo_count(task, info):
+    """各项任务插入的图片数：台账和闭环报告包含两个文件夹，检查报告只有隐患照片（合成数据的每一行都会写入报告）"""
+    if task == "generate_check_report":
+        return info["photos"]["隐患照片"]
+    return info["photos"]["隐患照片"] + info["photos"]["闭环照片"]
+
+def run_benchmark(info, out_dir, options, tasks=BENCH_TASKS, repeat=1):
+    """逐项在独立子进程中运行任务，重复 repeat 次取最短耗时和最大峰值内存，返回 {任务: 结果}"""
+    os.makedirs(out_dir, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for task in tasks:
+        runs = []
+        for _ in range(repeat):
+            result_queue = context.Queue()
+            process = context.Process(target=_measure_task, args=(task, info, out_dir, options, result_queue))
+            process.start()
+            result = result_queue.get()
+            process.join()
+            if "error" in result:
+                raise RuntimeError(f"{task} 运行失败:\n{result['error']}")
+            runs.append(result)
+        seconds = min(r["seconds"] for r in runs)
+        photos = task_photo_count(task, info)
+        children = [r["children_peak_mb"] for r in runs if r["children_peak_mb"] is not None]
+        results[task] = {
+            "seconds": round(seconds, 3),
+            "runs": [round(r["seconds"], 3) for r in runs],
+            "rows_per_s": round(info["rows"] / seconds, 2),
+            "photos": photos,
+            "photos_per_s": round(photos / seconds, 2),
+            "peak_mb": round(max(r["peak_mb"] for r in runs), 1),
+            "children_peak_mb": round(max(children), 1) if children else None,
+            "memory_method": runs[0]["memory_method"],
+            "output_mb": round(runs[0]["output_mb"], 1),
+        }
+        print(f"{task}: {seconds:.2f} 秒，{results[task]['rows_per_s']} 行/秒，"
+              f"{results[task]['photos_per_s']} 张/秒，峰值内存 {results[task]['peak_mb']} MB")
+    return results
+
+def environment_info():
+    """记录运行环境，比较基准结果时用于判断是否在同一台机器上测得"""
+    versions = {}
+    for module in ("openpyxl", "docx", "PIL", "pillow_heif"):
+        try:
+            versions[module] = getattr(__import__(module), "__version__", None)
+        except ImportError:
+            versions[module] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions,
+    }
+
+COMPARED_METRICS = ("seconds", "peak_mb")
+
+def compare_with_baseline(report, baseline, tolerance):
+    """
+    与基准结果比较耗时和峰值内存，返回回退项列表 [(任务, 指标, 基准值, 当前值)]
+    参数或运行环境不同时仍会比较，但打印警告
+    """
+    if baseline.get("params") != report["params"]:
+        print("警告: 基准结果的测试参数与本次不同，比较结果仅供参考")
+    if baseline.get("environment", {}).get("platform") != report["environment"]["platform"]:
+        print("警告: 基准结果在不同的运行环境中测得，比较结果仅供参考")
+
+    regressions = []
+    for task, result in report["results"].items():
+        base = baseline.get("results", {}).get(task)
+        if not base:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = base.get(metric), result.get(metric)
+            if old and new is not None:
+                change = new / old - 1
+                flag = "回退" if change > tolerance else ""
+                print(f"{task} {metric}: {old} → {new}（{change:+.1%}）{flag}")
+                if change > tolerance:
+                    regressions.append((task, metric, old, new))
+    return regressions
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="隐患整改台账与报告生成工具性能基准测试")
+    parser.add_argument("--rows", type=int, default=200, help="合成台账行数，默认 200")
+    parser.add_argument("--seed", type=int, default=1, help="随机种子，相同种子生成相同的数据集")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"图片格式比例，默认 {DEFAULT_MIX}")
+    parser.add_argument("--work-dir", default=os.path.join(tempfile.gettempdir(), "隐患整改台账基准测试"),
+                        help="合成数据和输出文件目录，已生成的数据集会被复用")
+    parser.add_argument("--tasks", nargs="+", choices=BENCH_TASKS, default=list(BENCH_TASKS), help="要测量的任务")
+    parser.add_argument("--repeat", type=int, default=1, help="每项任务重复次数，取最短耗时")
+    parser.add_argument("--workers", type=int, help="图片转码进程数")
+    parser.add_argument("--profile", choices=sorted(tool.OUTPUT_PROFILES), help="输出档位")
+    parser.add_argument("--resample", choices=tool.RESAMPLE_MODES, help="缩放模式")
+    parser.add_argument("--streaming", action="store_true", default=None, help="台账使用流式写出")
+    parser.add_argument("--output", help="结果 JSON 文件，省略则只打印")
+    parser.add_argument("--baseline", help="基准结果 JSON 文件，与之比较并在回退时以状态 1 退出")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="允许的回退比例，默认 0.15（15%%）")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+
+    print(f"准备 {args.rows} 行合成数据...")
+    start = time.perf_counter()
+    info = make_synthetic_dataset(args.rows, args.work_dir, args.seed, args.mix)
+    print(f"数据集 {info['name']}：{info['photos']}，{info['formats']}，压缩包 {info['zip_mb']} MB"
+          f"（{time.perf_counter() - start:.1f} 秒）")
+
+    options = {"workers": args.workers, "resample": args.resample, "profile": args.profile, "streaming": args.streaming}
+    results = run_benchmark(info, os.path.join(args.work_dir, "output"), options, args.tasks, args.repeat)
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "environment": environment_info(),
+        "params": {"rows": info["rows"], "seed": info["seed"], "mix": info["mix"], "photos": info["photos"],
+                   "formats": info["formats"], **options},
+        "results": results,
+    }
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"结果已写入 {args.output}")
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"发现 {len(regressions)} 项性能回退（容差 {args.tolerance:.0%}）")
+            return 1
+        print("未发现性能回退")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
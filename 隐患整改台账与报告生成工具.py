@@ -1,283 +1,2065 @@
 import os
 import zipfile
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
-from openpyxl import load_workbook
-from openpyxl.drawing.image import Image as XLImage
-from PIL import Image as PILImage
+import zlib
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import multiprocessing
+import argparse
+import json
+import sys
+import platform
+import time
 import io
+import re
+import queue
+import secrets
+import hmac
+import threading
 import warnings
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-from docx.oxml.ns import qn
-from datetime import datetime
-import pandas as pd
-
-# 启用 HEIC 支持
-try:
-    from pillow_heif import register_heif_opener
-    register_heif_opener()
-except ImportError:
-    pass
+from contextlib import contextmanager, nullcontext
+from datetime import date, datetime
+
+# openpyxl、python-docx、PIL、pillow_heif 导入耗时较长，只在用到它们的处理阶段才导入，
+# 这样图形界面和命令行可以立即启动，只生成台账时也不必加载 Word 相关模块
+
+_pil_image_module = None
+
+def _pil():
+    """首次使用时导入 PIL，并启用 HEIC 支持"""
+    global _pil_image_module
+    if _pil_image_module is None:
+        from PIL import Image as PILImage
+        try:
+            from pillow_heif import register_heif_opener
+            register_heif_opener()
+        except ImportError:
+            pass
+        _pil_image_module = PILImage
+    return _pil_image_module
 
 warnings.filterwarnings("ignore", category=UserWarning, module='PIL')
 
-# 图片目标尺寸：3.5cm x 5cm → 像素（600 DPI）
+# 图片目标尺寸：3.5cm x 5cm → 像素（600 DPI），同时用作台账中图片的显示尺寸
 CM_TO_PIXEL = 600 / 2.54
 IMG_WIDTH_PX = int(5 * CM_TO_PIXEL)    # ≈ 1181 (5cm宽度 @ 600 DPI)
 IMG_HEIGHT_PX = int(3.5 * CM_TO_PIXEL) # ≈ 827 (3.5cm高度 @ 600 DPI)
 
+# 输出档位：嵌入图片的 DPI（决定 5cm x 3.5cm 对应的像素尺寸）、JPEG 质量和色度抽样
+# subsampling：-1 为 Pillow 默认（4:2:0），0 为 4:4:4，2 为 4:2:0
+OUTPUT_PROFILES = {
+    "print":  {"dpi": 600, "quality": 95, "subsampling": -1},  # 打印，与历史输出一致
+    "screen": {"dpi": 220, "quality": 85, "subsampling": 2},   # 屏幕审阅
+    "email":  {"dpi": 150, "quality": 75, "subsampling": 2},   # 邮件、飞书上传
+}
+OUTPUT_PROFILE = "print"
+
+# 限定文件大小时，超出单张预算的图片依次尝试的 JPEG 质量，仍超出时再逐步缩小像素尺寸
+TARGET_SIZE_QUALITY_STEPS = (85, 75, 65, 55, 45, 35)
+TARGET_SIZE_SCALE_STEP = 0.8
+TARGET_SIZE_MIN_WIDTH_PX = 160
+# 限定文件大小时为 XML、模板等非图片内容预留的空间
+TARGET_SIZE_RESERVED_BYTES = 256 * 1024
+
+def resolve_output_profile(profile=None):
+    """返回输出档位设置，附带按 DPI 换算的像素尺寸"""
+    if profile is None:
+        profile = OUTPUT_PROFILE
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"未知的输出档位: {profile}")
+    settings = dict(OUTPUT_PROFILES[profile])
+    cm_to_pixel = settings["dpi"] / 2.54
+    settings["size"] = (int(5 * cm_to_pixel), int(3.5 * cm_to_pixel))
+    return settings
+
+def photo_byte_budget(target_mb, photo_count):
+    """将整份文件的大小上限（MB）平均分配给每张图片，返回单张图片的字节预算"""
+    if not target_mb or photo_count == 0:
+        return None
+    usable = target_mb * 1024 * 1024 - TARGET_SIZE_RESERVED_BYTES
+    return max(int(usable / photo_count), 1)
+
 # openpyxl 行列尺寸参考值
 COL_WIDTH_FOR_IMG = 35   # E 和 M 列宽度
 ROW_HEIGHT_FOR_IMG = 100 # 插入图片的行高
 
-def embed_images_to_excel(excel_path, zip_path, output_path):
-    wb = load_workbook(excel_path)
-    ws = wb.active
+# 图片转码进程数（None 表示使用全部 CPU 核心，1 表示在主进程中串行转码）
+TRANSCODE_WORKERS = None
 
-    if ws.cell(row=1, column=1).value != "隐患编号":
-        raise ValueError("Excel 第一列标题必须是“隐患编号”")
+# 缩放模式：
+#   "exact" 全尺寸解码后直接 LANCZOS 缩放（与历史输出逐字节一致）
+#   "fast"  JPEG 在解码阶段按 1/2、1/4、1/8 缩小（draft），其他格式先用 reduce 整数倍缩小，
+#           缩到接近目标尺寸后再做最终的 LANCZOS 缩放
+RESAMPLE_MODES = ("exact", "fast")
+RESAMPLE_MODE = "exact"
 
-    folder_images = extract_zip_to_dict(zip_path)
-    risk_photos = folder_images["隐患照片"]
-    close_loop_photos = folder_images["闭环照片"]
+# fast 模式下 reduce 后保留的尺寸余量（倍数），余量越大画质越接近 exact
+FAST_REDUCING_GAP = 1.5
 
-    # 初始化错误列表
-    errors = []
+def _encode_jpeg(pil_img, dpi, quality, subsampling):
+    img_buffer = io.BytesIO()
+    pil_img.save(img_buffer, format='JPEG', dpi=(dpi, dpi), quality=quality, subsampling=subsampling)
+    return img_buffer.getvalue()
 
-    # 先设置列宽（E列=隐患照片, M列=闭环照片）
-    ws.column_dimensions['E'].width = COL_WIDTH_FOR_IMG
-    ws.column_dimensions['M'].width = COL_WIDTH_FOR_IMG
+# 内嵌预览图与原图宽高比的允许误差
+PREVIEW_ASPECT_TOLERANCE = 0.01
+
+def _jpeg_draft_scale(image_size, size):
+    """JPEG 按 draft 缩小解码时采用的比例 1、2、4 或 8（与 PIL 的选择方式相同）"""
+    scale = min(image_size[0] // size[0], image_size[1] // size[1])
+    for candidate in (8, 4, 2, 1):
+        if scale >= candidate:
+            return candidate
+    return 1
+
+def _jpeg_previews(pil_img, img_data):
+    """
+    逐个给出 JPEG 内嵌的预览图（尚未解码）：MPF 中标为大尺寸缩略图的帧，读取失败的跳过
+    EXIF 缩略图受 64 KB 限制，不会比按 1/8 缩小解码的原图更合适，不在此列
+    """
+    PILImage = _pil()
+    entries = (getattr(pil_img, "mpinfo", None) or {}).get(0xB002, [])
+    for frame, entry in enumerate(entries):
+        if frame and str(entry["Attribute"].get("MPType", "")).startswith("Large Thumbnail"):
+            try:
+                preview = PILImage.open(io.BytesIO(img_data))
+                preview.seek(frame)
+            except Exception:
+                continue
+            yield preview
+
+def embedded_preview(pil_img, img_data, size):
+    """
+    快速缩放模式下可代替原图解码的 JPEG 内嵌预览图：不小于目标尺寸 size、宽高比与原图一致，
+    且像素数少于原图按 draft 缩小解码后的像素数；没有合适的预览图时返回 None
+    HEIC 的内嵌缩略图不在这里处理，由 pillow_heif 在 draft 中选择
+    """
+    if pil_img.format not in ("JPEG", "MPO"):
+        return None
+    width, height = pil_img.size
+    scale = _jpeg_draft_scale(pil_img.size, size)
+    best, best_area = None, -(-width // scale) * -(-height // scale)
+    for preview in _jpeg_previews(pil_img, img_data):
+        preview_width, preview_height = preview.size
+        if preview_width < size[0] or preview_height < size[1]:
+            continue
+        if abs(preview_width * height - preview_height * width) > PREVIEW_ASPECT_TOLERANCE * preview_height * width:
+            continue
+        if preview_width * preview_height < best_area:
+            best, best_area = preview, preview_width * preview_height
+    return best
+
+def transcode_image(img_data, resample_mode="exact", profile=None, max_bytes=None, timings=None):
+    """
+    将原始图片缩放为 5cm x 3.5cm（按输出档位的 DPI）并重新编码为 JPEG 数据
+    指定 max_bytes 时，超出预算的图片逐级降低质量，仍超出再缩小像素尺寸
+    timings 为字典时写入源图格式、解码方式（source）和解码、缩放、编码各步骤的耗时（秒）；
+    解码方式为 full（原图）、draft（JPEG 缩小解码）或 embedded（内嵌预览图 / 缩略图）
+    """
+    if resample_mode not in RESAMPLE_MODES:
+        raise ValueError(f"未知的缩放模式: {resample_mode}")
+    settings = resolve_output_profile(profile)
+    size = settings["size"]
+
+    PILImage = _pil()
+    start = time.perf_counter()
+    pil_img = PILImage.open(io.BytesIO(img_data))
+    source_format, source_size = pil_img.format, pil_img.size
+    source = "full"
+    if resample_mode == "fast":
+        preview = embedded_preview(pil_img, img_data, size)
+        if preview is not None:
+            pil_img, source = preview, "embedded"
+        # JPEG 解码时即按 1/2、1/4、1/8 缩小；支持 draft 的 pillow_heif 改为解码不小于目标尺寸的内嵌缩略图
+        pil_img.draft(None, size)
+        if source == "full" and pil_img.size != source_size:
+            source = "draft" if source_format in ("JPEG", "MPO") else "embedded"
+    # 先显式解码（resize 本身也会触发），以便分别统计解码和缩放耗时
+    pil_img.load()
+    decoded = time.perf_counter()
+    if timings is not None:
+        timings["format"] = source_format
+        timings["source"] = source
+        timings["megapixels"] = source_size[0] * source_size[1] / 1e6
+        timings["decode"] = decoded - start
+    if resample_mode == "fast":
+        pil_img = pil_img.resize(size, PILImage.LANCZOS, reducing_gap=FAST_REDUCING_GAP)
+    else:
+        pil_img = pil_img.resize(size, PILImage.LANCZOS)
+    if pil_img.mode in ("RGBA", "P"):
+        pil_img = pil_img.convert("RGB")
+    resized = time.perf_counter()
+    if timings is not None:
+        timings["resize"] = resized - decoded
+
+    data = _fit_jpeg(pil_img, settings, max_bytes)
+    if timings is not None:
+        timings["encode"] = time.perf_counter() - resized
+    return data
+
+def _fit_jpeg(pil_img, settings, max_bytes):
+    """按档位编码已缩放的图片，超出 max_bytes 时逐级降低质量，仍超出再缩小像素尺寸"""
+    PILImage = _pil()
+    size = settings["size"]
+    data = _encode_jpeg(pil_img, settings["dpi"], settings["quality"], settings["subsampling"])
+    if max_bytes is None or len(data) <= max_bytes:
+        return data
+
+    for quality in TARGET_SIZE_QUALITY_STEPS:
+        if quality >= settings["quality"]:
+            continue
+        data = _encode_jpeg(pil_img, settings["dpi"], quality, 2)
+        if len(data) <= max_bytes:
+            return data
+
+    # 最低质量仍超出预算：按比例缩小像素尺寸（显示尺寸不变，DPI 随之降低）
+    width, height = size
+    while len(data) > max_bytes and width * TARGET_SIZE_SCALE_STEP >= TARGET_SIZE_MIN_WIDTH_PX:
+        scale = TARGET_SIZE_SCALE_STEP
+        width, height = int(width * scale), int(height * scale)
+        dpi = max(int(settings["dpi"] * width / size[0]), 1)
+        data = _encode_jpeg(pil_img.resize((width, height), PILImage.LANCZOS), dpi, TARGET_SIZE_QUALITY_STEPS[-1], 2)
+    return data
+
+# 缩略图磁盘缓存目录（None 表示不使用缓存）和容量上限
+THUMBNAIL_CACHE_DIR = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "隐患整改台账与报告生成工具", "thumbnails")
+THUMBNAIL_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 2 GB
+
+class ThumbnailCache:
+    """
+    以源图片内容哈希加目标尺寸、DPI、质量为键的磁盘缩略图缓存
+    超出容量上限时按最近使用时间（文件修改时间）淘汰
+    """
+    def __init__(self, cache_dir, max_bytes=THUMBNAIL_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def key(self, img_data, resample_mode="exact", profile=None, max_bytes=None):
+        """计算缓存键，转码参数变化时键随之变化"""
+        settings = resolve_output_profile(profile)
+        params = (f"{settings['size'][0]}x{settings['size'][1]}|{settings['dpi']}dpi|q{settings['quality']}"
+                  f"|s{settings['subsampling']}|{resample_mode}|{max_bytes}|")
+        digest = hashlib.sha256(params.encode("ascii"))
+        digest.update(img_data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".jpg")
+
+    def get(self, key):
+        """读取缓存的 JPEG 数据，未命中返回 None；命中时刷新使用时间"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """写入缓存，先写临时文件再替换，避免中断时留下残缺文件"""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # 缓存写入失败不影响生成结果
+            pass
+
+    def trim(self):
+        """总大小超过上限时，从最久未使用的缩略图开始删除"""
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+_default_thumbnail_cache = None
+
+def default_thumbnail_cache():
+    """
+    返回按 THUMBNAIL_CACHE_DIR 配置的共享缓存，未配置目录时返回 None
+    启用了常驻缓存（enable_warm_caches）时，在磁盘缓存前面再加一层内存缓存
+    """
+    global _default_thumbnail_cache
+    disk_cache = None
+    if THUMBNAIL_CACHE_DIR is not None:
+        if _default_thumbnail_cache is None or _default_thumbnail_cache.cache_dir != THUMBNAIL_CACHE_DIR:
+            _default_thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR)
+        disk_cache = _default_thumbnail_cache
+    if _warm_caches is not None:
+        return _warm_caches.thumbnail_cache(disk_cache)
+    return disk_cache
+
+def memory_thumbnail_cache():
+    """启用了常驻缓存时返回不写磁盘的内存缩略图缓存，否则返回 None"""
+    if _warm_caches is not None:
+        return _warm_caches.thumbnail_cache(None)
+    return None
+
+# 常驻进程（后台服务、图形界面）在多次生成之间保留的缓存上限：打开的图片压缩包索引个数、内存缩略图总大小
+WARM_ZIP_INDEX_CACHE_SIZE = 4
+WARM_PHOTO_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 512 MB
+
+class MemoryThumbnailCache:
+    """
+    内存缩略图缓存，接口与 ThumbnailCache 相同：按最近使用淘汰，总大小不超过 max_bytes
+    传给其他进程（如分册进程）时只带上容量设置，内存中的图片不复制
+    """
+    key = ThumbnailCache.key
+    cache_dir = None
+
+    def __init__(self, max_bytes=WARM_PHOTO_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__, total_bytes=0, _entries={})
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+                self.hits += 1
+            else:
+                self.misses += 1
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old)
+            self._entries[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                self.total_bytes -= len(self._entries.pop(next(iter(self._entries))))
+
+    def trim(self):
+        """写入时即已限制大小"""
+
+    def stats(self):
+        with self._lock:
+            return {"photos": len(self._entries), "mb": round(self.total_bytes / 1024 / 1024, 1),
+                    "hits": self.hits, "misses": self.misses}
+
+class LayeredThumbnailCache:
+    """内存缓存在前、磁盘缓存在后的缩略图缓存：内存未命中再查磁盘（命中的也放入内存），写入时两边都写"""
+    key = ThumbnailCache.key
+
+    def __init__(self, memory, backing):
+        self.memory = memory
+        self.backing = backing
+        self.cache_dir = backing.cache_dir
 
+    def get(self, key):
+        data = self.memory.get(key)
+        if data is None:
+            data = self.backing.get(key)
+            if data is not None:
+                self.memory.put(key, data)
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        self.backing.put(key, data)
+
+    def trim(self):
+        self.backing.trim()
+
+class WarmCaches:
+    """
+    常驻进程在多次生成之间保留的状态（报告模板的编译结果本来就按进程缓存，不在此处）：
+    - 图片压缩包索引：按路径、修改时间和大小缓存，最多 zip_indexes 个，打开的压缩包保持打开
+    - 转码后的图片：内存缩略图缓存，最多 photo_bytes 字节
+    - 转码进程池：keep_pool 为 True 时保留，省去每次生成启动进程和在进程中导入图像库的时间
+    fork 出的子进程（如分册进程）继承的压缩包与父进程共用同一文件读写位置，子进程中首次使用时丢弃继承的索引和进程池
+    """
+    def __init__(self, zip_indexes=WARM_ZIP_INDEX_CACHE_SIZE, photo_bytes=WARM_PHOTO_CACHE_MAX_BYTES, keep_pool=True):
+        self.zip_indexes = zip_indexes
+        self.photo_bytes = photo_bytes
+        self.keep_pool = keep_pool
+        self.photos = None
+        self._indexes = {}
+        self._pool = None
+        self._pool_workers = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _check_process(self):
+        """
+        在 fork 出的子进程中丢弃从父进程继承的压缩包索引、进程池和锁
+        内存缩略图缓存的内容照常使用，只换掉它的锁：fork 时父进程的其他线程可能正持有该锁，子进程中永远不会释放
+        """
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._pool = None
+        self._pool_workers = None
+        if self.photos is not None:
+            self.photos._lock = threading.Lock()
+
+    def photo_index(self, zip_path):
+        """返回压缩包索引，缓存的索引标记为 shared，使用方调用 close() 时不会关闭"""
+        if self.zip_indexes <= 0:
+            return ZipPhotoIndex(zip_path)
+        self._check_process()
+        path = os.path.abspath(zip_path)
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._indexes.pop(path, None)
+            if cached is not None and cached[0] != signature:
+                cached[1].close(force=True)
+                cached = None
+            if cached is None:
+                cached = (signature, ZipPhotoIndex(path))
+                cached[1].shared = True
+            self._indexes[path] = cached
+            while len(self._indexes) > self.zip_indexes:
+                self._indexes.pop(next(iter(self._indexes)))[1].close(force=True)
+        return cached[1]
+
+    def thumbnail_cache(self, backing):
+        """
+        返回以 backing（磁盘缓存或 None）为后备的内存缩略图缓存，backing 为 None 时只用内存
+        不同后备共用同一份内存缓存；未启用内存缓存（photo_bytes 为 0）时返回 backing
+        """
+        if self.photo_bytes <= 0:
+            return backing
+        self._check_process()
+        with self._lock:
+            if self.photos is None:
+                self.photos = MemoryThumbnailCache(self.photo_bytes)
+        return LayeredThumbnailCache(self.photos, backing) if backing is not None else self.photos
+
+    def transcode_pool(self, workers):
+        """返回常驻的转码进程池，进程数变化或进程池已损坏时重新创建"""
+        self._check_process()
+        with self._lock:
+            if self._pool is not None and (self._pool_workers != workers or getattr(self._pool, "_broken", False)):
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=workers)
+                self._pool_workers = workers
+            return self._pool
+
+    def stats(self):
+        with self._lock:
+            zip_paths = list(self._indexes)
+        return {"templates": len(_compiled_templates), "zip_indexes": zip_paths,
+                "photos": self.photos.stats() if self.photos else None, "pool_workers": self._pool_workers}
+
+    def close(self):
+        self._check_process()
+        with self._lock:
+            for signature, index in self._indexes.values():
+                index.close(force=True)
+            self._indexes.clear()
+            if self._pool is not None:
+                self._pool.shutdown(cancel_futures=True)
+                self._pool = None
+
+_warm_caches = None
+
+def enable_warm_caches(**kwargs):
+    """在常驻进程中启用常驻缓存（参数见 WarmCaches），之后的生成都使用这些缓存，返回 WarmCaches"""
+    global _warm_caches
+    if _warm_caches is not None:
+        _warm_caches.close()
+    _warm_caches = WarmCaches(**kwargs)
+    return _warm_caches
+
+def open_photo_index(zip_path):
+    """打开图片压缩包索引，启用了常驻缓存时复用已建立的索引"""
+    if _warm_caches is not None:
+        return _warm_caches.photo_index(zip_path)
+    return ZipPhotoIndex(zip_path)
+
+def transcode_pool(workers, job_count):
+    """
+    返回 (转码进程池, 用完后是否由调用方关闭)；单进程或只有一张图片时返回 (None, False)
+    启用常驻缓存且保留进程池时复用常驻进程池
+    """
+    if workers <= 1 or job_count <= 1:
+        return None, False
+    if _warm_caches is not None and _warm_caches.keep_pool:
+        return _warm_caches.transcode_pool(workers), False
+    return ProcessPoolExecutor(max_workers=min(workers, job_count)), True
+
+# 默认是否增量生成：True 时每次生成在输出文件旁保存清单，下次生成复用上次输出中未变化的图片
+INCREMENTAL = False
+# 增量生成清单的文件名后缀，写在输出文件旁
+MANIFEST_SUFFIX = ".manifest.json"
+# 重新生成期间上次输出文件改名后的后缀
+PREVIOUS_SUFFIX = ".previous"
+# 清单格式版本，输出内容的生成方式改变时递增，使旧清单失效
+MANIFEST_VERSION = 1
+
+def file_sha1(path):
+    """分块计算文件内容的 SHA1"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def output_settings(kind, resample=None, profile=None, target_mb=None, template_path=None, streaming=False):
+    """影响输出内容的设置，任何一项变化都会使上次的清单失效"""
+    settings = {
+        "version": MANIFEST_VERSION,
+        "kind": kind,
+        "resample": resample or RESAMPLE_MODE,
+        "profile": resolve_output_profile(profile),
+        "target_mb": target_mb,
+        "template": compile_report_template(template_path).sha1 if template_path else None,
+        "streaming": bool(streaming),
+    }
+    # 经过一次 JSON 转换，与从清单文件读回的设置可以直接比较
+    return json.loads(json.dumps(settings))
+
+class IncrementalRun:
+    """
+    增量生成：每个输出文件旁保存清单（输出文件名 + MANIFEST_SUFFIX），记录台账文件哈希、
+    压缩包中照片的 CRC 和大小、每张照片转码结果的 CRC 和大小及其在输出文件中的媒体部件，以及影响输出的设置
+    照片和媒体部件都以 ZIP 目录中已有的 CRC 和大小标识，判断是否变化和查找上次的转码结果都不需要读取文件内容
+    下次生成时台账、照片和设置都未变化则直接跳过；否则重新生成，CRC 和大小未变的照片直接从上次的输出文件中取出转码结果，
+    不再读取和转码。行文字的写入本身很快，输出文件整体重新生成
+    上次的输出文件被修改过（大小或修改时间与清单不符）或设置不同时，清单不再使用
+    台账只按整个文件的哈希判断是否变化，不逐行解析，以免每次重新生成都为此多读一遍台账
+    上次生成被强制结束、留下改名保留的上次输出（输出文件名 + PREVIOUS_SUFFIX）时，与清单相符则恢复，否则删除
+    """
+    def __init__(self, excel_path, zip_path, outputs):
+        """outputs 为 {输出文件路径: output_settings(...)}"""
+        self.outputs = outputs
+        self.ledger_sha1 = file_sha1(excel_path)
+        with open_photo_index(zip_path) as photo_index:
+            self.photo_signatures = {(folder, key): [info.CRC, info.file_size]
+                                     for folder, infos in photo_index.folders.items() for key, info in infos.items()}
+        self.zip_signature = hashlib.sha1(json.dumps(sorted(
+            [folder, key, *signature] for (folder, key), signature in self.photo_signatures.items()),
+            ensure_ascii=False).encode("utf-8")).hexdigest()
+        self.previous = {}
+        for output_path, settings in outputs.items():
+            manifest = self._load(output_path)
+            self._recover_previous(output_path, manifest)
+            if manifest is None:
+                continue
+            if manifest.get("settings") == settings and self._output_intact(output_path, manifest):
+                self.previous[output_path] = manifest
+        self._moved = {}
+        self._archives = {}
+        self._photo_media = {}
+        self.reused = 0
+
+    @staticmethod
+    def _load(output_path):
+        try:
+            with open(output_path + MANIFEST_SUFFIX, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def _recover_previous(cls, output_path, manifest):
+        """处理上次生成中途被强制结束时留下的改名保留的输出文件"""
+        moved = output_path + PREVIOUS_SUFFIX
+        if not os.path.exists(moved):
+            return
+        if manifest is not None and cls._output_intact(moved, manifest):
+            # 清单描述的正是这份文件，覆盖可能写了一半的输出文件
+            os.replace(moved, output_path)
+        else:
+            os.remove(moved)
+
+    @staticmethod
+    def _output_intact(output_path, manifest):
+        try:
+            stat = os.stat(output_path)
+        except OSError:
+            return False
+        return manifest.get("output") == {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    def unchanged(self):
+        """全部输出文件都有有效清单，且台账和压缩包与上次相同"""
+        return len(self.previous) == len(self.outputs) and all(
+            manifest["ledger_sha1"] == self.ledger_sha1 and manifest["zip"] == self.zip_signature
+            for manifest in self.previous.values())
+
+    def errors(self, output_path):
+        """上次生成该输出文件时记录的图片错误"""
+        return list(self.previous[output_path].get("errors", []))
+
+    def __enter__(self):
+        # 输出文件会被重新写入，生成期间把上次的输出改名保留，从中读取复用的图片
+        for output_path in self.previous:
+            moved = output_path + PREVIOUS_SUFFIX
+            os.replace(output_path, moved)
+            self._moved[output_path] = moved
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for archive in self._archives.values():
+            archive.close()
+        self._archives.clear()
+        for output_path, moved in self._moved.items():
+            if exc_type is None:
+                os.remove(moved)
+            else:
+                # 生成失败或取消时恢复上次的输出文件
+                os.replace(moved, output_path)
+        self._moved.clear()
+
+    def get(self, job):
+        """返回照片未变化时上次的转码结果，没有可复用的结果时返回 None（供 prepare_photos 的 reuse 参数使用）"""
+        signature = self.photo_signatures.get(job)
+        if signature is None:
+            return None
+        name = "/".join(job)
+        for output_path, manifest in self.previous.items():
+            # 限定了输出文件大小时，每张照片的字节预算随照片总数变化，不复用
+            if manifest["settings"]["target_mb"] is not None or output_path not in self._moved:
+                continue
+            entry = manifest["photos"].get(name)
+            if not entry or entry[:2] != signature or entry[2] not in manifest["media"]:
+                continue
+            archive = self._archives.get(output_path)
+            if archive is None:
+                archive = self._archives[output_path] = zipfile.ZipFile(self._moved[output_path])
+            try:
+                data = archive.read(manifest["media"][entry[2]])
+            except KeyError:
+                continue
+            self.reused += 1
+            return data
+        return None
+
+    @staticmethod
+    def media_id(crc, size):
+        """媒体内容的标识：CRC32 加字节数"""
+        return f"{crc:08x}:{size}"
+
+    def record(self, prepared):
+        """记录本次转码结果的标识，转码失败的记为 None"""
+        for job, (img_data, error) in prepared.items():
+            self._photo_media[job] = self.media_id(zlib.crc32(img_data), len(img_data)) if error is None else None
+
+    def save(self, output_path, wanted=None, errors=()):
+        """输出文件写完后保存其清单，wanted 为该文件使用的照片，None 表示本次处理过的全部照片"""
+        if wanted is None:
+            wanted = self._photo_media
+        photos = {"/".join(job): self.photo_signatures[job] + [self._photo_media[job]]
+                  for job in dict.fromkeys(wanted) if job in self.photo_signatures and job in self._photo_media}
+        # 输出文件中各媒体部件的标识，下次据此找到每张照片的转码结果
+        media = {}
+        with zipfile.ZipFile(output_path) as archive:
+            for info in archive.infolist():
+                if "/media/" in info.filename:
+                    media.setdefault(self.media_id(info.CRC, info.file_size), info.filename)
+        stat = os.stat(output_path)
+        manifest = {
+            "settings": self.outputs[output_path],
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "ledger_sha1": self.ledger_sha1,
+            "zip": self.zip_signature,
+            "photos": photos,
+            "media": media,
+            "errors": list(errors),
+            "output": {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns},
+        }
+        with open(output_path + MANIFEST_SUFFIX, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False)
+
+class GenerationCancelled(Exception):
+    """用户取消了生成，由进度回调抛出"""
+
+def report_progress(progress, stage, done, total):
+    """
+    通知进度回调 progress(阶段, 已完成数, 总数)，progress 为 None 时忽略
+    回调可抛出 GenerationCancelled 中止生成，各生成函数只在处理单元之间调用，中止时不会留下写了一半的数据
+    """
+    if progress is not None:
+        progress(stage, done, total)
+
+# 性能剖析报告的文件名后缀，写在输出文件旁
+PROFILE_REPORT_SUFFIX = ".profile.json"
+# 性能剖析报告中列出的最慢图片数
+PROFILE_SLOWEST_IMAGES = 20
+# 内存采样的最小间隔（秒）
+PROFILE_MEMORY_INTERVAL = 0.5
+
+def memory_usage_mb():
+    """返回本进程的 (当前内存, 峰值内存)，单位 MB，无法测量的项为 None"""
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+        get_current_process.restype = wintypes.HANDLE
+        get_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        if get_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize / 1048576, counters.PeakWorkingSetSize / 1048576
+        return None, None
+
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(fields["VmRSS"].split()[0]) / 1024, int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None, None
+    # macOS 单位为字节，其他系统为 KB
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return None, maxrss / (1048576 if sys.platform == "darwin" else 1024)
+
+class PerfProfiler:
+    """
+    性能剖析记录：各阶段的累计耗时和次数、逐张图片的解码/缩放/编码耗时、内存采样
+    作为 profiler 参数传给各生成函数，生成完成后在输出文件旁写出 JSON 报告（输出文件名 + PROFILE_REPORT_SUFFIX）
+    图片的各步骤耗时在转码进程中测得，多进程转码时其合计为各进程耗时之和，会大于“转码图片”阶段的实际耗时
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.images = []
+        self.memory = []
+        self.info = {}
+        self._last_sample = None
+        self.sample_memory("开始", force=True)
+
+    @contextmanager
+    def stage(self, name):
+        """统计 with 块的耗时，计入阶段 name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+            self.sample_memory(name)
+
+    def add(self, name, seconds, count=1):
+        stage = self.stages.setdefault(name, {"seconds": 0.0, "count": 0})
+        stage["seconds"] += seconds
+        stage["count"] += count
+
+    def add_image(self, job, source_bytes, result, timings):
+        """记录一张图片的转码结果和各步骤耗时"""
+        folder, key = job
+        img_data, error = result
+        record = {"folder": folder, "key": key, "source_bytes": source_bytes,
+                  "output_bytes": len(img_data) if img_data else 0, "error": error}
+        record.update(timings)
+        self.images.append(record)
+        self.sample_memory("转码图片")
+
+    def sample_memory(self, label, force=False):
+        """记录一次内存采样，两次采样至少间隔 PROFILE_MEMORY_INTERVAL 秒（force 为 True 时除外）"""
+        now = time.perf_counter()
+        if not force and self._last_sample is not None and now - self._last_sample < PROFILE_MEMORY_INTERVAL:
+            return
+        self._last_sample = now
+        rss, peak = memory_usage_mb()
+        self.memory.append({"seconds": round(now - self.start, 3), "stage": label,
+                            "rss_mb": round(rss, 1) if rss is not None else None,
+                            "peak_mb": round(peak, 1) if peak is not None else None})
+
+    def report(self):
+        """汇总为可写出 JSON 的字典"""
+        self.sample_memory("结束", force=True)
+        steps = ("decode", "resize", "encode")
+        images = []
+        for image in self.images:
+            image = dict(image, total=sum(image.get(step, 0.0) for step in steps))
+            images.append({name: round(value, 4) if isinstance(value, float) else value for name, value in image.items()})
+        images.sort(key=lambda image: image["total"], reverse=True)
+        transcode = {step: round(sum(image.get(step, 0.0) for image in self.images), 3) for step in steps}
+        transcode["images"] = len(self.images)
+        # 按源图格式汇总，并按解码方式（full 原图 / draft 缩小解码 / embedded 内嵌预览图）分别统计解码耗时
+        formats = {}
+        for image in self.images:
+            entry = formats.setdefault(image.get("format") or "未知", {"images": 0, **{step: 0.0 for step in steps}, "sources": {}})
+            entry["images"] += 1
+            for step in steps:
+                entry[step] += image.get(step, 0.0)
+            source = entry["sources"].setdefault(image.get("source", "full"), {"images": 0, "decode": 0.0, "megapixels": 0.0})
+            source["images"] += 1
+            source["decode"] += image.get("decode", 0.0)
+            source["megapixels"] += image.get("megapixels", 0.0)
+        for entry in formats.values():
+            # 快速路径节省的解码时间：按同格式原图解码的每百万像素耗时，估算这些图片按原图解码所需的时间再相减
+            full = entry["sources"].get("full")
+            fast = [source for name, source in entry["sources"].items() if name != "full"]
+            if fast and full and full["megapixels"]:
+                rate = full["decode"] / full["megapixels"]
+                entry["fast_path_saved"] = round(sum(source["megapixels"] * rate - source["decode"] for source in fast), 3)
+            for step in steps:
+                entry[step] = round(entry[step], 3)
+            for source in entry["sources"].values():
+                source["decode"] = round(source["decode"], 3)
+                source["megapixels"] = round(source["megapixels"], 1)
+        peaks = [sample["peak_mb"] for sample in self.memory if sample["peak_mb"] is not None]
+        return {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "total_seconds": round(time.perf_counter() - self.start, 3),
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "cpu_count": os.cpu_count()},
+            "settings": self.info,
+            "stages": {name: {"seconds": round(stage["seconds"], 3), "count": stage["count"]}
+                       for name, stage in self.stages.items()},
+            "transcode_seconds": transcode,
+            "formats": formats,
+            "slowest_images": images[:PROFILE_SLOWEST_IMAGES],
+            "memory": {"peak_mb": max(peaks, default=None), "samples": self.memory},
+        }
+
+    def write(self, output_path):
+        """在输出文件旁写出报告，返回报告路径"""
+        report_path = output_path + PROFILE_REPORT_SUFFIX
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        return report_path
+
+def profile_stage(profiler, name):
+    """返回统计阶段 name 耗时的上下文管理器，profiler 为 None 时不计时"""
+    return profiler.stage(name) if profiler is not None else nullcontext()
+
+# 解码明显慢于其他格式的图片扩展名，并行转码时优先提交
+SLOW_PHOTO_EXTENSIONS = (".heic", ".heif", ".hif")
+
+def _transcode_job(img_data, resample_mode, profile, max_bytes, timed=False):
+    """
+    进程池任务：返回 (JPEG 数据, 错误信息)，异常在子进程内转为文本以便回传
+    timed 为 True 时返回 ((JPEG 数据, 错误信息), 各步骤耗时)
+    """
+    timings = {} if timed else None
+    try:
+        result = transcode_image(img_data, resample_mode, profile, max_bytes, timings), None
+    except Exception as e:
+        result = None, str(e)
+    return (result, timings) if timed else result
+
+def prepare_photos(photo_index, wanted, workers=None, cache=None, resample=None, profile=None, target_mb=None,
+                   pool=None, photo_count=None, trim_cache=True, progress=None, profiler=None, reuse=None):
+    """
+    在逐行写入之前集中转码所需图片
+    wanted 为 (文件夹, 隐患编号) 序列，返回 {(文件夹, 隐患编号): (JPEG 数据, 错误信息)}
+    cache 为 None 时使用默认缩略图缓存，为 False 时不使用缓存
+    resample 为缩放模式（"exact" 或 "fast"），None 时使用 RESAMPLE_MODE
+    profile 为输出档位名称，None 时使用 OUTPUT_PROFILE；target_mb 为输出文件的大小上限（MB）
+    图片按需从压缩包读取，同时在途的原图数量受进程数限制，内存占用与压缩包大小无关
+    分批调用时可传入共用的进程池 pool、全部批次的图片总数 photo_count（用于分配 target_mb），
+    并以 trim_cache=False 推迟缓存清理
+    progress 为进度回调，每处理完一张图片报告一次；profiler 为 PerfProfiler 时记录读取耗时和逐张图片的转码耗时
+    reuse 为增量生成的 IncrementalRun：reuse.get(图片) 返回上次的转码结果时直接使用，不再读取和转码，
+    全部图片处理完后交给 reuse.record 记录转码结果的哈希
+    """
+    start = time.perf_counter()
+    if cache is None:
+        cache = default_thumbnail_cache()
+    if workers is None:
+        workers = TRANSCODE_WORKERS or os.cpu_count() or 1
+    if resample is None:
+        resample = RESAMPLE_MODE
+    if resample not in RESAMPLE_MODES:
+        raise ValueError(f"未知的缩放模式: {resample}")
+    if profile is None:
+        profile = OUTPUT_PROFILE
+    resolve_output_profile(profile)
+
+    jobs = [(folder, key) for folder, key in dict.fromkeys(wanted) if key in photo_index.folders[folder]]
+    max_bytes = photo_byte_budget(target_mb, len(jobs) if photo_count is None else photo_count)
+
+    # 按源图片内容分组：同一张图片只转码一次，缓存命中的直接复用
+    groups = {}
+    results = {}
+    inflight = {}
+    own_pool = False
+    if pool is None:
+        pool, own_pool = transcode_pool(workers, len(jobs))
+    if pool is not None:
+        # HEIC 解码最慢：先提交，避免最后只剩几张 HEIC 在个别进程中转码、其余进程空闲
+        jobs.sort(key=lambda job: os.path.splitext(photo_index.folders[job[0]][job[1]].filename)[1].lower()
+                  not in SLOW_PHOTO_EXTENSIONS)
+    max_inflight = workers * 2
+
+    finished = 0
+    timed = profiler is not None
+    source_sizes = {}
+    if timed:
+        profiler.info.update(workers=workers, resample=resample, profile=profile, target_mb=target_mb)
+
+    def advance():
+        nonlocal finished
+        finished += 1
+        report_progress(progress, "转码图片", finished, len(jobs))
+
+    def store(cache_key, result):
+        if timed:
+            result, timings = result
+            profiler.add_image(groups[cache_key][0], source_sizes[cache_key], result, timings)
+        results[cache_key] = result
+        if cache and result[1] is None:
+            cache.put(cache_key, result[0])
+
+    def collect(futures):
+        for future in futures:
+            store(inflight.pop(future), future.result())
+            advance()
+
+    try:
+        for job in jobs:
+            reused = reuse.get(job) if reuse is not None else None
+            if reused is not None:
+                groups[job] = [job]
+                results[job] = (reused, None)
+                if timed:
+                    profiler.add("复用上次输出", 0.0)
+                advance()
+                continue
+            try:
+                with profile_stage(profiler, "读取压缩包"):
+                    img_data = photo_index.read(*job)
+            except Exception as e:
+                groups[job] = [job]
+                results[job] = (None, str(e))
+                advance()
+                continue
+
+            cache_key = cache.key(img_data, resample, profile, max_bytes) if cache else hashlib.sha256(img_data).hexdigest()
+            groups.setdefault(cache_key, []).append(job)
+            if len(groups[cache_key]) > 1:
+                advance()
+                continue
+
+            cached = cache.get(cache_key) if cache else None
+            if timed:
+                source_sizes[cache_key] = len(img_data)
+            if cached is not None:
+                results[cache_key] = (cached, None)
+                if timed:
+                    profiler.add("缩略图缓存命中", 0.0)
+                advance()
+            elif pool is None:
+                store(cache_key, _transcode_job(img_data, resample, profile, max_bytes, timed))
+                advance()
+            else:
+                if len(inflight) >= max_inflight:
+                    done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                    collect(done)
+                inflight[pool.submit(_transcode_job, img_data, resample, profile, max_bytes, timed)] = cache_key
+        collect(list(inflight))
+    finally:
+        if own_pool:
+            pool.shutdown(cancel_futures=True)
+        else:
+            # 共用的进程池不关闭，中止时只取消本次提交的任务
+            for future in inflight:
+                future.cancel()
+
+    if cache and trim_cache and len(results) > 0:
+        cache.trim()
+    if timed:
+        profiler.add("转码图片", time.perf_counter() - start)
+
+    prepared = {job: results[cache_key] for cache_key, group in groups.items() for job in group}
+    if reuse is not None:
+        reuse.record(prepared)
+    return prepared
+
+def photo_data(prepared, folder, key):
+    """取出预先转码好的图片数据，转码失败时抛出原始错误信息"""
+    img_data, error = prepared[(folder, key)]
+    if error is not None:
+        raise ValueError(error)
+    return img_data
+
+# 保存 xlsx/docx 时图片媒体部件不压缩直接存入（ZIP_STORED），只压缩 XML 等其余部件；
+# JPEG、PNG 本身已经压缩，再 deflate 几乎不减小文件，却是保存大型报告时最耗时的一步
+STORE_MEDIA_UNCOMPRESSED = True
+# 按扩展名判断的已压缩媒体格式
+STORED_MEDIA_EXTENSIONS = (".jpeg", ".jpg", ".png", ".gif")
+
+def is_stored_media(name):
+    """压缩包中的部件 name 是否为不再压缩的图片媒体文件"""
+    return "/media/" in name and name.lower().endswith(STORED_MEDIA_EXTENSIONS)
+
+class PackageZipFile(zipfile.ZipFile):
+    """
+    写出 xlsx/docx 的压缩包：默认 deflate 压缩，store_media 为 True 时图片媒体部件改为直接存入
+    store_media 为 None 时取 STORE_MEDIA_UNCOMPRESSED；直接存入的图片数据由 writestr 原样写入输出文件，不经压缩器复制
+    """
+    def __init__(self, file, store_media=None):
+        super().__init__(file, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        self.store_media = STORE_MEDIA_UNCOMPRESSED if store_media is None else store_media
+
+    def writestr(self, zinfo_or_arcname, data, compress_type=None, compresslevel=None):
+        if (compress_type is None and self.store_media and isinstance(zinfo_or_arcname, str)
+                and is_stored_media(zinfo_or_arcname)):
+            compress_type = zipfile.ZIP_STORED
+        super().writestr(zinfo_or_arcname, data, compress_type, compresslevel)
+
+class _DocumentPackageWriter:
+    """代替 python-docx 的物理包写出器，把各部件写入 PackageZipFile"""
+    def __init__(self, output_path):
+        self._archive = PackageZipFile(output_path)
+
+    def write(self, pack_uri, blob):
+        self._archive.writestr(pack_uri.membername, blob)
+
+    def close(self):
+        self._archive.close()
+
+def save_document(doc, output_path):
+    """保存 Word 文档，与 doc.save 相同，图片媒体部件按 STORE_MEDIA_UNCOMPRESSED 不压缩存入"""
+    from docx.opc.pkgwriter import PackageWriter
+
+    package = doc.part.package
+    for part in package.parts:
+        part.before_marshal()
+    writer = _DocumentPackageWriter(output_path)
+    try:
+        PackageWriter._write_content_types_stream(writer, package.parts)
+        PackageWriter._write_pkg_rels(writer, package.rels)
+        PackageWriter._write_parts(writer, package.parts)
+    finally:
+        writer.close()
+
+_openpyxl_classes = None
+
+def _package_image_classes():
+    """
+    首次使用时导入 openpyxl 并定义以下两个类，返回 (_PackageImage, _PackageExcelWriter)
+    _PackageImage：直接使用已转码 JPEG 数据的 openpyxl 图片，不再经 PIL 重新解析；
+        shared 为内容相同的先插入图片时，两者共用同一个媒体文件；
+        path 为已写入压缩包的媒体文件路径时（流式写出），不再保留图片数据
+    _PackageExcelWriter：按媒体路径去重写出图片的写出器，共用媒体文件或已写入压缩包的图片不再重复写入
+    """
+    global _openpyxl_classes
+    if _openpyxl_classes is not None:
+        return _openpyxl_classes
+
+    from openpyxl.drawing.image import Image as XLImage
+    from openpyxl.writer.excel import ExcelWriter
+
+    class _PackageImage(XLImage):
+        def __init__(self, img_data, shared=None, path=None):
+            self.ref = None
+            self.format = "jpeg"
+            self.width = IMG_WIDTH_PX
+            self.height = IMG_HEIGHT_PX
+            self._img_data = img_data
+            self._shared = shared
+            self._media_path = path
+
+        def _data(self):
+            return self._img_data
+
+        @property
+        def path(self):
+            if self._media_path is not None:
+                return self._media_path
+            if self._shared is not None:
+                return self._shared.path
+            return super().path
+
+    class _PackageExcelWriter(ExcelWriter):
+        def _write_images(self):
+            written = {"/" + name for name in self._archive.namelist()}
+            for img in self._images:
+                if img.path in written:
+                    continue
+                written.add(img.path)
+                self._archive.writestr(img.path[1:], img._data())
+
+    _openpyxl_classes = (_PackageImage, _PackageExcelWriter)
+    return _openpyxl_classes
+
+def save_workbook(wb, output_path):
+    """保存工作簿，内容相同的图片在 xlsx 中只保留一份媒体文件，图片媒体部件按 STORE_MEDIA_UNCOMPRESSED 不压缩存入"""
+    _PackageImage, _PackageExcelWriter = _package_image_classes()
+    archive = PackageZipFile(output_path)
+    _PackageExcelWriter(wb, archive).save()
+
+class DocumentImages:
+    """
+    按内容哈希管理 Word 文档中的图片部件：同一张图片只生成一个媒体文件，后续插入直接引用同一关系
+    python-docx 每次插图都会对全部已有图片重新计算 SHA1 并线性查找可用文件名，图片多时开销随数量平方增长
+    """
+    def __init__(self, doc):
+        self.part = doc.part
+        self.image_parts = self.part.package.image_parts
+        self._parts_by_sha1 = {image_part.sha1: image_part for image_part in self.image_parts}
+        self._used_numbers = {image_part.partname.idx for image_part in self.image_parts}
+        self._next_number = 1
+        self._inserted = {}
+        self._next_shape_id = self.part.next_id
+
+    def _image_part(self, img_data, sha1):
+        from docx.image.image import Image as DocxImage
+        from docx.parts.image import ImagePart
+        from docx.opc.packuri import PackURI
+
+        image_part = self._parts_by_sha1.get(sha1)
+        if image_part is None:
+            image = DocxImage.from_blob(img_data)
+            # 与 python-docx 相同的命名规则：取最小的未使用编号
+            n = self._next_number
+            while n in self._used_numbers:
+                n += 1
+            self._used_numbers.add(n)
+            self._next_number = n + 1
+            image_part = ImagePart.from_image(image, PackURI(f"/word/media/image{n}.{image.ext}"))
+            self.image_parts.append(image_part)
+            self._parts_by_sha1[sha1] = image_part
+        return image_part
+
+    def add_picture(self, r, img_data, width, height):
+        """在 w:r 元素中插入图片，效果等同 run.add_picture"""
+        from docx.opc.constants import RELATIONSHIP_TYPE as RT
+        from docx.oxml.shape import CT_Inline
+
+        sha1 = hashlib.sha1(img_data).hexdigest()
+        inserted = self._inserted.get(sha1)
+        if inserted is None:
+            image_part = self._image_part(img_data, sha1)
+            inserted = self._inserted[sha1] = (self.part.relate_to(image_part, RT.IMAGE), image_part.image)
+        rId, image = inserted
+        cx, cy = image.scaled_dimensions(width, height)
+        shape_id = self._next_shape_id
+        self._next_shape_id += 1
+        r.add_drawing(CT_Inline.new_pic_inline(shape_id, rId, image.filename, cx, cy))
+
+# 检查报告、闭环报告依赖的台账列
+REQUIRED_COLUMNS = ['隐患编号', '异常类别', '隐患级别', '异常事项', '班组', '整改人', '发现时间', '要求闭环时间']
+
+def load_ledger_sheet(excel_path):
+    """加载台账工作簿，返回 (工作簿, 第一个工作表, 隐患编号列表)；与 read_ledger 一样总是使用第一个工作表"""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(excel_path)
+    ws = wb.worksheets[0]
+
+    if ws.cell(row=1, column=1).value != "隐患编号":
+        raise ValueError("Excel 第一列标题必须是“隐患编号”")
+
+    # 读取全部隐患编号，直到第一列出现空单元格
+    keys = []
     row_idx = 2
     while True:
         cell_value = ws.cell(row=row_idx, column=1).value
         if cell_value is None:
             break
-        key = str(cell_value).strip()
+        keys.append(str(cell_value).strip())
+        row_idx += 1
 
-        inserted = False
+    return wb, ws, keys
 
-        # 隐患照片 → E列
-        if key in risk_photos:
-            try:
-                img_data = risk_photos[key]
-                pil_img = PILImage.open(io.BytesIO(img_data))
-                pil_img = pil_img.resize((IMG_WIDTH_PX, IMG_HEIGHT_PX), PILImage.LANCZOS)
-                if pil_img.mode in ("RGBA", "P"):
-                    pil_img = pil_img.convert("RGB")
-                img_buffer = io.BytesIO()
-                pil_img.save(img_buffer, format='JPEG', dpi=(600, 600), quality=95)
-                img_buffer.seek(0)
-                xl_img = XLImage(img_buffer)
-                xl_img.width = IMG_WIDTH_PX
-                xl_img.height = IMG_HEIGHT_PX
-                ws.add_image(xl_img, f"E{row_idx}")
-                inserted = True
-            except Exception as e:
-                errors.append(f"第 {row_idx} 行（隐患编号 {key}）隐患照片插入失败: {str(e)}")
+# 报告中各列的文本：异常事项、异常类别、班组、整改人、发现时间、要求闭环时间
+REPORT_TEXT_COLUMNS = ['异常事项', '异常类别', '班组', '整改人', '发现时间', '要求闭环时间']
+# 转换为 YYYY-MM-DD 文本的日期列
+LEDGER_DATE_COLUMNS = ('发现时间', '要求闭环时间')
+# 文本形式的日期：2025-03-02、2025/3/2、2025.3.2、2025年3月2日、月在前的 3/2/2025（与 pandas 默认一致，第一个数大于 12 时
+# 按日在前），后面都可带时间；或 20250302。两位数年份和英文月份名不识别
+LEDGER_DATE_PATTERN = re.compile(r"(\d{4})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})(?!\d)|(\d{4})(\d{2})(\d{2})$"
+                                 r"|(\d{1,2})\s*[-/.]\s*(\d{1,2})\s*[-/.]\s*(\d{4})(?!\d)")
+
+class HazardRecord:
+    """
+    台账中的一条隐患：隐患编号、异常类别、隐患级别，
+    以及报告各列的文本 texts（按 REPORT_TEXT_COLUMNS 顺序，日期已转换为 YYYY-MM-DD，空值为 ""）
+    """
+    __slots__ = ("hazard_id", "category", "level", "texts")
+
+    def __init__(self, hazard_id, category, level, texts):
+        self.hazard_id = hazard_id
+        self.category = category
+        self.level = level
+        self.texts = texts
 
-        # 闭环照片 → M列
-        if key in close_loop_photos:
+def ledger_text(value):
+    """单元格的值转为文本：空值为 ""，整数值的浮点数不带小数部分"""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def ledger_date(value):
+    """日期列的值转为 YYYY-MM-DD 文本：支持日期单元格、Excel 日期序列号和常见的文本写法，无法识别的为 """""
+    if isinstance(value, (datetime, date)):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        from openpyxl.utils.datetime import from_excel
+
+        try:
+            return from_excel(value).strftime('%Y-%m-%d')
+        except (ValueError, OverflowError):
+            return ""
+    match = LEDGER_DATE_PATTERN.match(str(value).strip()) if value is not None else None
+    if not match:
+        return ""
+    if match.group(1):
+        year, month, day = match.group(1, 2, 3)
+    elif match.group(4):
+        year, month, day = match.group(4, 5, 6)
+    else:
+        month, day, year = match.group(7, 8, 9)
+        if int(month) > 12:
+            # 与 pandas 一样，第一个数不可能是月份时按日在前解析（13/5/2025）
+            month, day = day, month
+    try:
+        return date(int(year), int(month), int(day)).strftime('%Y-%m-%d')
+    except ValueError:
+        return ""
+
+def ledger_records(rows):
+    """
+    由台账各行的值（第一行为表头）逐行生成 HazardRecord，整行为空的行跳过
+    表头只检查一次，缺少 REQUIRED_COLUMNS 中的列时抛出 ValueError；同名列以第一列为准
+    """
+    rows = iter(rows)
+    positions = {}
+    for index, name in enumerate(next(rows, ())):
+        if name is not None:
+            positions.setdefault(str(name).strip(), index)
+    missing_cols = [col for col in REQUIRED_COLUMNS if col not in positions]
+    if missing_cols:
+        raise ValueError(f"Excel文件中缺少以下列: {missing_cols}")
+
+    id_col, category_col, level_col = positions['隐患编号'], positions['异常类别'], positions['隐患级别']
+    text_cols = [(positions[col], ledger_date if col in LEDGER_DATE_COLUMNS else ledger_text) for col in REPORT_TEXT_COLUMNS]
+    for values in rows:
+        if all(value is None for value in values):
+            continue
+        # 只读模式下行尾的空单元格可能不在元组中
+        width = len(values)
+        yield HazardRecord(ledger_text(values[id_col] if id_col < width else None).strip(),
+                           ledger_text(values[category_col] if category_col < width else None),
+                           ledger_text(values[level_col] if level_col < width else None),
+                           tuple(convert(values[col] if col < width else None) for col, convert in text_cols))
+
+def read_ledger(excel_path):
+    """
+    以 openpyxl 只读模式逐行读取台账第一个工作表（公式取缓存的计算结果），返回 HazardRecord 列表
+    不构造整张表的 DataFrame，只保留报告用到的几列
+    """
+    from openpyxl import load_workbook
+
+    wb = load_workbook(excel_path, read_only=True, data_only=True)
+    try:
+        return list(ledger_records(wb.worksheets[0].iter_rows(values_only=True)))
+    finally:
+        wb.close()
+
+# 台账中插入图片的列：隐患照片 → E列，闭环照片 → M列
+EXCEL_PHOTO_COLUMNS = (("隐患照片", "E"), ("闭环照片", "M"))
+# 台账默认写出方式：True 时使用流式写出（内存占用与台账行数无关）
+EXCEL_STREAMING = False
+# 流式写出时每批转码并写出的行数
+EXCEL_STREAMING_CHUNK_ROWS = 100
+
+def excel_photo_requests(keys):
+    """台账需要的图片：每行的隐患照片和闭环照片"""
+    return [(folder, key) for key in keys for folder, column in EXCEL_PHOTO_COLUMNS]
+
+def excel_row_photos(prepared, row_idx, key, errors):
+    """逐个返回该行可插入的 (列字母, JPEG 数据)，读取或转码失败的照片记入 errors"""
+    for folder, column in EXCEL_PHOTO_COLUMNS:
+        if (folder, key) in prepared:
             try:
-                img_data = close_loop_photos[key]
-                pil_img = PILImage.open(io.BytesIO(img_data))
-                pil_img = pil_img.resize((IMG_WIDTH_PX, IMG_HEIGHT_PX), PILImage.LANCZOS)
-                if pil_img.mode in ("RGBA", "P"):
-                    pil_img = pil_img.convert("RGB")
-                img_buffer = io.BytesIO()
-                pil_img.save(img_buffer, format='JPEG', dpi=(600, 600), quality=95)
-                img_buffer.seek(0)
-                xl_img = XLImage(img_buffer)
-                xl_img.width = IMG_WIDTH_PX
-                xl_img.height = IMG_HEIGHT_PX
-                ws.add_image(xl_img, f"M{row_idx}")
-                inserted = True
+                yield column, photo_data(prepared, folder, key)
             except Exception as e:
-                errors.append(f"第 {row_idx} 行（隐患编号 {key}）闭环照片插入失败: {str(e)}")
+                errors.append(f"第 {row_idx} 行（隐患编号 {key}）{folder}插入失败: {str(e)}")
+
+def fill_excel_images(ws, keys, prepared, progress=None):
+    """将预先转码的图片插入台账 E 列（隐患照片）和 M 列（闭环照片），返回错误列表"""
+    # 初始化错误列表
+    errors = []
+
+    # 先设置列宽（E列=隐患照片, M列=闭环照片）
+    for folder, column in EXCEL_PHOTO_COLUMNS:
+        ws.column_dimensions[column].width = COL_WIDTH_FOR_IMG
+
+    # 内容相同的图片共用第一次插入时的媒体文件
+    _PackageImage, _PackageExcelWriter = _package_image_classes()
+    inserted_images = {}
+
+    def package_image(img_data):
+        sha1 = hashlib.sha1(img_data).digest()
+        xl_img = _PackageImage(img_data, shared=inserted_images.get(sha1))
+        inserted_images.setdefault(sha1, xl_img)
+        return xl_img
+
+    for row_idx, key in enumerate(keys, start=2):
+        inserted = False
+        for column, img_data in excel_row_photos(prepared, row_idx, key, errors):
+            ws.add_image(package_image(img_data), f"{column}{row_idx}")
+            inserted = True
 
         # 如果该行插入了图片，设置行高
         if inserted:
             ws.row_dimensions[row_idx].height = ROW_HEIGHT_FOR_IMG
+        report_progress(progress, "写入台账", row_idx - 1, len(keys))
 
-        row_idx += 1
+    return errors
+
+# 流式写出时与源工作簿共用的样式表属性，单元格的样式编号因此可以原样保留
+_SHARED_STYLE_ATTRS = ("_fonts", "_fills", "_borders", "_alignments", "_protections", "_number_formats",
+                       "_date_formats", "_timedelta_formats", "_colors", "_cell_styles", "_named_styles",
+                       "_table_styles", "_differential_styles")
+# 在数据行之前写出的工作表属性，需在追加第一行之前复制
+_SHEET_TOP_PROPERTIES = ("sheet_properties", "views", "sheet_format")
+# 在数据行之后写出的工作表属性，读完全部数据行后复制
+_SHEET_TAIL_PROPERTIES = ("print_options", "page_margins", "page_setup", "HeaderFooter", "auto_filter",
+                          "data_validations", "row_breaks", "col_breaks", "scenarios", "protection")
+
+def stream_excel_images(excel_path, zip_path, output_path, workers=None, cache=None, resample=None, profile=None,
+                        target_mb=None, chunk_rows=None, progress=None, profiler=None, reuse=None):
+    """
+    流式生成带图片台账：逐行读取源工作表并写入只写工作簿，图片按批转码后立即写入输出文件
+    复制单元格值和样式、列宽、行高、合并单元格、数据验证、条件格式、视图和打印设置（批注、超链接、表格对象不复制）
+    内存中只保留当前一批行的图片和每张图片的锚点，峰值内存与台账行数无关
+    progress 为进度回调，按已写出的行数报告；中止或出错时删除未写完的输出文件
+    profiler 为 PerfProfiler 时记录各阶段耗时（写入台账包含逐行解析源工作表），reuse 见 prepare_photos
+    返回错误列表
+    """
+    from openpyxl import Workbook, load_workbook
+    from openpyxl.worksheet._reader import WorkSheetParser
+    from openpyxl.worksheet.dimensions import ColumnDimension, RowDimension
+    from openpyxl.worksheet.cell_range import MultiCellRange
+    from openpyxl.cell.cell import Cell
+
+    if workers is None:
+        workers = TRANSCODE_WORKERS or os.cpu_count() or 1
+    if cache is None:
+        cache = default_thumbnail_cache()
+    chunk_rows = chunk_rows or EXCEL_STREAMING_CHUNK_ROWS
 
-    wb.save(output_path)
+    src_wb = load_workbook(excel_path, read_only=True)
+    try:
+        src_ws = src_wb.worksheets[0]
+
+        # 读取全部隐患编号，直到第一列出现空单元格
+        keys = []
+        with profile_stage(profiler, "读取台账"):
+            for row_idx, (cell_value,) in enumerate(src_ws.iter_rows(max_col=1, values_only=True), start=1):
+                if row_idx == 1:
+                    if cell_value != "隐患编号":
+                        raise ValueError("Excel 第一列标题必须是“隐患编号”")
+                    continue
+                if cell_value is None:
+                    break
+                keys.append(str(cell_value).strip())
+        if profiler is not None:
+            profiler.info.update(rows=len(keys), streaming=True)
+
+        out_wb = Workbook(write_only=True)
+        for attr in _SHARED_STYLE_ATTRS:
+            setattr(out_wb, attr, getattr(src_wb, attr))
+        for attr in ("properties", "loaded_theme", "epoch", "views", "calculation", "security"):
+            setattr(out_wb, attr, getattr(src_wb, attr))
+        out_ws = out_wb.create_sheet(src_ws.title)
+
+        _PackageImage, _PackageExcelWriter = _package_image_classes()
+        # 先打开图片压缩包，压缩包不存在或损坏时不会留下写了一半的输出文件
+        photo_index = open_photo_index(zip_path)
+        try:
+            archive = PackageZipFile(output_path)
+        except BaseException:
+            photo_index.close()
+            raise
+        errors = []
+        media_paths = {}
+        pool = None
+        own_pool = False
+        try:
+            photo_count = sum(1 for job in dict.fromkeys(excel_photo_requests(keys))
+                              if job[1] in photo_index.folders[job[0]])
+            pool, own_pool = transcode_pool(workers, photo_count)
+
+            def copy_sheet_top(parser):
+                for attr in _SHEET_TOP_PROPERTIES:
+                    value = getattr(parser, attr, None)
+                    if value is not None:
+                        setattr(out_ws, attr, value)
+                for column, dim in parser.column_dimensions.items():
+                    if 'style' in dim:
+                        dim['style'] = out_wb._cell_styles[int(dim['style'])]
+                    out_ws.column_dimensions[column] = ColumnDimension(out_ws, **dim)
+                # 先设置列宽（E列=隐患照片, M列=闭环照片）
+                for folder, column in EXCEL_PHOTO_COLUMNS:
+                    out_ws.column_dimensions[column].width = COL_WIDTH_FOR_IMG
+
+            written_rows = 0
+            photos_done = 0
+
+            def chunk_progress(stage, done, total):
+                # 各批的转码进度累计为整个台账的图片进度
+                report_progress(progress, "转码并写入台账", min(photos_done + done, photo_count), photo_count)
+
+            def write_chunk(parser, chunk):
+                """转码一批行的图片并写入媒体文件，随后写出这些行"""
+                nonlocal written_rows, photos_done
+                chunk_keys = [keys[row_idx - 2] for row_idx, cells in chunk if 2 <= row_idx < len(keys) + 2]
+                prepared = prepare_photos(photo_index, excel_photo_requests(chunk_keys), workers, cache, resample, profile,
+                                          target_mb, pool=pool, photo_count=photo_count, trim_cache=False,
+                                          progress=chunk_progress, profiler=profiler, reuse=reuse)
+                photos_done += len(prepared)
+                row_start = time.perf_counter()
+                for row_idx, cells in chunk:
+                    # 源工作表中缺少的行写出为空行，保持行号不变
+                    while written_rows < row_idx - 1:
+                        out_ws.append([])
+                        written_rows += 1
+
+                    dim = parser.row_dimensions.pop(str(row_idx), None)
+                    if dim is not None:
+                        if 's' in dim:
+                            dim['s'] = out_wb._cell_styles[int(dim['s'])]
+                        out_ws.row_dimensions[row_idx] = RowDimension(out_ws, **dim)
+
+                    if 2 <= row_idx < len(keys) + 2:
+                        key = keys[row_idx - 2]
+                        inserted = False
+                        for column, img_data in excel_row_photos(prepared, row_idx, key, errors):
+                            # 内容相同的图片共用第一次写入的媒体文件
+                            sha1 = hashlib.sha1(img_data).digest()
+                            path = media_paths.get(sha1)
+                            if path is None:
+                                path = media_paths[sha1] = f"/xl/media/image{len(media_paths) + 1}.jpeg"
+                                archive.writestr(path[1:], img_data)
+                            out_ws.add_image(_PackageImage(None, path=path), f"{column}{row_idx}")
+                            inserted = True
+                        # 如果该行插入了图片，设置行高
+                        if inserted:
+                            out_ws.row_dimensions[row_idx].height = ROW_HEIGHT_FOR_IMG
+
+                    row = [None] * max((cell['column'] for cell in cells), default=0)
+                    for cell in cells:
+                        c = Cell(out_ws, row=row_idx, column=cell['column'],
+                                 style_array=out_wb._cell_styles[cell['style_id']])
+                        c._value = cell['value']
+                        c.data_type = cell['data_type']
+                        row[cell['column'] - 1] = c
+                    out_ws.append(row)
+                    written_rows = row_idx
+                    out_ws.row_dimensions.pop(row_idx, None)
+                if profiler is not None:
+                    profiler.add("写入台账", time.perf_counter() - row_start, len(chunk))
+
+            with src_ws._get_source() as src:
+                parser = WorkSheetParser(src, src_ws._shared_strings, data_only=src_wb.data_only, epoch=src_wb.epoch,
+                                         date_formats=src_wb._date_formats, timedelta_formats=src_wb._timedelta_formats)
+                top_copied = False
+                chunk = []
+                for row_idx, cells in parser.parse():
+                    if not top_copied:
+                        copy_sheet_top(parser)
+                        top_copied = True
+                    chunk.append((row_idx, cells))
+                    if len(chunk) >= chunk_rows:
+                        write_chunk(parser, chunk)
+                        chunk = []
+                if not top_copied:
+                    copy_sheet_top(parser)
+                write_chunk(parser, chunk)
+
+                # 数据行之后的属性：合并单元格、条件格式、数据验证、打印设置等
+                if parser.merged_cells:
+                    out_ws.merged_cells = MultiCellRange([cell_range.ref for cell_range in parser.merged_cells.mergeCell])
+                for cf in parser.formatting:
+                    for rule in cf.rules:
+                        if rule.dxfId is not None:
+                            rule.dxf = out_wb._differential_styles[rule.dxfId]
+                        out_ws.conditional_formatting[cf] = rule
+                for attr in _SHEET_TAIL_PROPERTIES:
+                    value = getattr(parser, attr, None)
+                    if value is not None:
+                        setattr(out_ws, attr, value)
+        except BaseException:
+            # 中止或出错时删除未写完的输出文件
+            archive.close()
+            os.remove(output_path)
+            raise
+        finally:
+            if own_pool:
+                pool.shutdown(cancel_futures=True)
+            photo_index.close()
+
+        # 媒体文件已全部写入，此处只写出工作表、绘图和其余部件
+        with profile_stage(profiler, "保存文件"):
+            _PackageExcelWriter(out_wb, archive).save()
+        if cache:
+            cache.trim()
+    finally:
+        src_wb.close()
 
     return errors
 
-def generate_check_report(excel_path, doc_template_path, zip_path, output_path):
-    # 读取Excel文件
-    df = pd.read_excel(excel_path)
-    
-    # 检查关键列是否存在
-    required_cols = ['隐患编号', '异常类别', '隐患级别', '异常事项', '班组', '整改人', '发现时间', '要求闭环时间']
-    missing_cols = [col for col in required_cols if col not in df.columns]
-    if missing_cols:
-        raise ValueError(f"Excel文件中缺少以下列: {missing_cols}")
-    
-    # 将日期列转换为指定格式
-    df = df.copy()
-    if '发现时间' in df.columns:
-        df['发现时间'] = pd.to_datetime(df['发现时间'], errors='coerce').dt.strftime('%Y-%m-%d')
-    if '要求闭环时间' in df.columns:
-        df['要求闭环时间'] = pd.to_datetime(df['要求闭环时间'], errors='coerce').dt.strftime('%Y-%m-%d')
-    
-    # 加载Word模板
-    doc = Document(doc_template_path)
-    
-    # 提取ZIP中的图片
-    folder_images = extract_zip_to_dict(zip_path)
-    
-    # 通过标题段落查找表格
-    env_table = find_table_by_title(doc, "二、环境保护")
-    general_table = find_table_by_title(doc, "一、本期存在主要问题")
-    major_table = find_table_by_title(doc, "三、重大事故隐患检查情况")
-    
+def start_incremental_run(incremental, excel_path, zip_path, outputs, progress=None, profiler=None):
+    """
+    incremental 为 None 时按 INCREMENTAL 决定是否增量生成；不增量生成时返回 None，
+    否则返回 IncrementalRun，outputs 为 {输出文件路径: output_settings(...)}
+    """
+    if incremental is None:
+        incremental = INCREMENTAL
+    if not incremental:
+        return None
+    with profile_stage(profiler, "增量检查"):
+        run = IncrementalRun(excel_path, zip_path, outputs)
+    if run.unchanged():
+        report_progress(progress, "台账和图片未变化，沿用上次的输出", 0, 0)
+    return run
+
+def embed_images_to_excel(excel_path, zip_path, output_path, workers=None, cache=None, resample=None, profile=None, target_mb=None,
+                          streaming=None, progress=None, profiler=None, incremental=None):
+    """
+    生成带图片台账，返回错误列表；streaming 为 None 时按 EXCEL_STREAMING 决定是否流式写出
+    progress 为进度回调 progress(阶段, 已完成数, 总数)，可抛出 GenerationCancelled 中止生成
+    profiler 为 PerfProfiler 时记录各阶段耗时，完成后在输出文件旁写出性能剖析报告
+    incremental 为 None 时按 INCREMENTAL 决定是否增量生成（见 IncrementalRun）
+    """
+    if streaming is None:
+        streaming = EXCEL_STREAMING
+    run = start_incremental_run(incremental, excel_path, zip_path,
+                                {output_path: output_settings("excel", resample, profile, target_mb, streaming=streaming)},
+                                progress, profiler)
+    if run is not None and run.unchanged():
+        errors = run.errors(output_path)
+    else:
+        with run or nullcontext():
+            if streaming:
+                errors = stream_excel_images(excel_path, zip_path, output_path, workers, cache, resample, profile, target_mb,
+                                             progress=progress, profiler=profiler, reuse=run)
+            else:
+                with profile_stage(profiler, "读取台账"):
+                    wb, ws, keys = load_ledger_sheet(excel_path)
+                if profiler is not None:
+                    profiler.info.update(rows=len(keys), streaming=False)
+
+                # 逐行写入前先从压缩包按需读取并集中转码所需图片
+                with open_photo_index(zip_path) as photo_index:
+                    prepared = prepare_photos(photo_index, excel_photo_requests(keys), workers, cache, resample, profile,
+                                              target_mb, progress=progress, profiler=profiler, reuse=run)
+
+                with profile_stage(profiler, "插入图片"):
+                    errors = fill_excel_images(ws, keys, prepared, progress)
+                report_progress(progress, "保存文件", 0, 0)
+                with profile_stage(profiler, "保存文件"):
+                    save_workbook(wb, output_path)
+            if run is not None:
+                run.save(output_path, None, errors)
+
+    if profiler is not None:
+        profiler.write(output_path)
+    return errors
+
+# 报告中各表格插入的图片：检查报告只有隐患照片，闭环报告有隐患照片和闭环照片
+CHECK_REPORT_PHOTOS = ("隐患照片",)
+CLOSURE_REPORT_PHOTOS = ("隐患照片", "闭环照片")
+
+# 报告模板中三个表格对应的标题
+REPORT_SECTION_TITLES = {
+    "env": "二、环境保护",
+    "general": "一、本期存在主要问题",
+    "major": "三、重大事故隐患检查情况",
+}
+# 进程内最多缓存的编译模板数量
+REPORT_TEMPLATE_CACHE_SIZE = 16
+
+class CompiledReportTemplate:
+    """
+    预编译的报告模板：模板文件内容、三个表格在 doc.tables 中的位置、各表格照片列的位置
+    每次生成只需从内存中的模板内容打开文档，不再读盘、查找标题和表头
+    """
+    def __init__(self, blob, mtime_ns, size, sha1):
+        from docx import Document
+
+        self.blob = blob
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.sha1 = sha1
+        doc = Document(io.BytesIO(blob))
+        elements = [table._element for table in doc.tables]
+        self.table_indexes = {}
+        self.columns = {}
+        for section, title in REPORT_SECTION_TITLES.items():
+            table = find_table_by_title(doc, title)
+            self.table_indexes[section] = elements.index(table._element) if table else None
+            if table:
+                self.columns[section] = {folder: find_column_index(table, folder) for folder in CLOSURE_REPORT_PHOTOS}
+
+    def open(self):
+        """打开一份新的模板文档，返回 (文档, {表格类别: 表格}, {表格类别: {照片列名: 列索引}})"""
+        from docx import Document
+
+        doc = Document(io.BytesIO(self.blob))
+        doc_tables = doc.tables
+        tables = {section: doc_tables[index] if index is not None else None
+                  for section, index in self.table_indexes.items()}
+        return doc, tables, self.columns
+
+_compiled_templates = {}
+_compiled_templates_lock = threading.Lock()
+
+def compile_report_template(doc_template_path):
+    """
+    返回模板的编译结果，按路径缓存在进程内
+    文件修改时间和大小未变时直接使用缓存；有变化时重新计算内容哈希，内容不同才重新编译
+    """
+    path = os.path.abspath(doc_template_path)
+    stat = os.stat(path)
+    with _compiled_templates_lock:
+        compiled = _compiled_templates.get(path)
+    if compiled and (compiled.mtime_ns, compiled.size) == (stat.st_mtime_ns, stat.st_size):
+        return compiled
+
+    with open(path, "rb") as f:
+        blob = f.read()
+    sha1 = hashlib.sha1(blob).hexdigest()
+    if compiled and compiled.sha1 == sha1:
+        compiled.mtime_ns, compiled.size = stat.st_mtime_ns, stat.st_size
+        return compiled
+
+    compiled = CompiledReportTemplate(blob, stat.st_mtime_ns, stat.st_size, sha1)
+    with _compiled_templates_lock:
+        _compiled_templates.pop(path, None)
+        _compiled_templates[path] = compiled
+        while len(_compiled_templates) > REPORT_TEMPLATE_CACHE_SIZE:
+            del _compiled_templates[next(iter(_compiled_templates))]
+    return compiled
+
+def load_report_template(doc_template_path):
+    """加载Word模板（使用编译缓存），返回 (文档, {表格类别: 表格}, {表格类别: {照片列名: 列索引}})"""
+    return compile_report_template(doc_template_path).open()
+
+def report_photo_requests(classified, photo_folders):
+    """报告需要的图片：写入表格的每行对应的各类照片"""
+    return [(folder, record.hazard_id) for section, record in classified for folder in photo_folders]
+
+# 环境保护、重大事故隐患表格没有数据行时添加的说明（针对全公司的结论）
+REPORT_EMPTY_NOTES = {
+    "env": "本次检查未发现公司存在环境保护相关问题",
+    "major": "根据《重大事故隐患清单》逐一排查，发现公司未存在重大事故隐患。",
+}
+# 分册中该表格没有数据行、但整份台账中有时添加的说明
+SHARD_EMPTY_NOTE = "本分册无此类隐患"
+
+def fill_report(doc, tables, classified, prepared, photo_folders, columns=None, progress=None, profiler=None, empty_notes=None):
+    """
+    将分好类的数据行连同预先转码的图片写入报告的三个表格，columns 为模板编译时得到的照片列位置
+    profiler 为 PerfProfiler 时分别记录表格格式（模板原有行和原型行）和写入数据行的耗时
+    empty_notes 为 {表格: 说明} 时代替 REPORT_EMPTY_NOTES 中相应表格为空时的说明（分册使用）
+    """
     # 初始化计数器
-    env_counter = 0
-    general_counter = 0
-    major_counter = 0
+    counters = {"env": 0, "general": 0, "major": 0}
+    images = DocumentImages(doc)
+    columns = columns or {}
+    with profile_stage(profiler, "表格格式"):
+        writers = {section: ReportTableWriter(table, photo_folders, images, columns.get(section))
+                   for section, table in tables.items() if table}
     
     # 处理每一行数据
-    for index, row in df.iterrows():
-        # 检查异常类别是否为"环境保护"
-        if str(row.get('异常类别', '')) == '环境保护':
-            if env_table:
-                env_counter += 1
-                add_row_to_table_with_images_from_zip(env_table, row, env_counter, folder_images, "隐患照片")
-        
-        # 检查隐患级别是否为"一般隐患"且异常类别不为"环境保护"
-        if str(row.get('隐患级别', '')) == '一般隐患' and str(row.get('异常类别', '')) != '环境保护':
-            if general_table:
-                general_counter += 1
-                add_row_to_table_with_images_from_zip(general_table, row, general_counter, folder_images, "隐患照片")
-        
-        # 检查隐患级别是否为"重大隐患"且异常类别不为"环境保护"
-        if str(row.get('隐患级别', '')) == '重大隐患' and str(row.get('异常类别', '')) != '环境保护':
-            if major_table:
-                major_counter += 1
-                add_row_to_table_with_images_from_zip(major_table, row, major_counter, folder_images, "隐患照片")
-    
-    # 如果环境保护表格为空，添加一行说明
-    if env_table and env_counter == 0:
-        new_row = env_table.add_row()
-        cells = new_row.cells
-        if len(cells) >= 8:  # 确保表格有足够的列
-            cells[0].text = "1"
-            cells[1].text = "本次检查未发现公司存在环境保护相关问题"
-            # 填充其余列
-            for i in range(2, len(cells)):
-                cells[i].text = "/"
-    
-    # 如果重大事故隐患检查情况表格为空，添加一行说明
-    if major_table and major_counter == 0:
-        new_row = major_table.add_row()
-        cells = new_row.cells
-        if len(cells) >= 8:  # 确保表格有足够的列
-            cells[0].text = "1"
-            cells[1].text = "根据《重大事故隐患清单》逐一排查，发现公司未存在重大事故隐患。"
-            # 填充其余列
-            for i in range(2, len(cells)):
-                cells[i].text = "/"
+    with profile_stage(profiler, "写入报告"):
+        for done, (section, record) in enumerate(classified, start=1):
+            counters[section] += 1
+            writers[section].add_record(counters[section], record, prepared)
+            report_progress(progress, "写入报告", done, len(classified))
     
-    # 为所有表格设置格式
-    if env_table:
-        apply_table_formatting(env_table)
-    if general_table:
-        apply_table_formatting(general_table)
-    if major_table:
-        apply_table_formatting(major_table)
+    # 表格列数不少于 7 列文字加各照片列时，才为空表格添加说明行
+    min_cols = 7 + len(photo_folders)
+
+    # 如果环境保护、重大事故隐患检查情况表格为空，添加一行说明
+    notes = {**REPORT_EMPTY_NOTES, **(empty_notes or {})}
+    for section, note in notes.items():
+        if section in writers and counters[section] == 0:
+            writers[section].add_note_row(note, min_cols)
     
-    # 保存文档
-    doc.save(output_path)
+    for writer in writers.values():
+        writer.flush()
 
-def generate_closure_report(excel_path, doc_template_path, zip_path, output_path):
+def _generate_report(excel_path, doc_template_path, zip_path, output_path, photo_folders, workers, cache, resample, profile, target_mb,
+                     progress, profiler, incremental, shard_by=None, processes=None):
+    if shard_by is not None:
+        return _generate_sharded_report(excel_path, doc_template_path, zip_path, output_path, photo_folders, shard_by, processes,
+                                        workers, cache, resample, profile, target_mb, progress, profiler)
+    settings = output_settings(f"report:{','.join(photo_folders)}", resample, profile, target_mb, doc_template_path)
+    run = start_incremental_run(incremental, excel_path, zip_path, {output_path: settings}, progress, profiler)
+    if run is None or not run.unchanged():
+        with run or nullcontext():
+            _write_report(excel_path, doc_template_path, zip_path, output_path, photo_folders, workers, cache, resample, profile,
+                          target_mb, progress, profiler, run)
+            if run is not None:
+                run.save(output_path)
+    if profiler is not None:
+        profiler.write(output_path)
+
+def _write_report(excel_path, doc_template_path, zip_path, output_path, photo_folders, workers, cache, resample, profile, target_mb,
+                  progress, profiler, run):
     # 读取Excel文件
-    df = pd.read_excel(excel_path)
-    
-    # 检查关键列是否存在
-    required_cols = ['隐患编号', '异常类别', '隐患级别', '异常事项', '班组', '整改人', '发现时间', '要求闭环时间']
-    missing_cols = [col for col in required_cols if col not in df.columns]
-    if missing_cols:
-        raise ValueError(f"Excel文件中缺少以下列: {missing_cols}")
-    
-    # 将日期列转换为指定格式
-    df = df.copy()
-    if '发现时间' in df.columns:
-        df['发现时间'] = pd.to_datetime(df['发现时间'], errors='coerce').dt.strftime('%Y-%m-%d')
-    if '要求闭环时间' in df.columns:
-        df['要求闭环时间'] = pd.to_datetime(df['要求闭环时间'], errors='coerce').dt.strftime('%Y-%m-%d')
+    with profile_stage(profiler, "读取台账"):
+        records = read_ledger(excel_path)
     
     # 加载Word模板
-    doc = Document(doc_template_path)
-    
-    # 提取ZIP中的图片
-    folder_images = extract_zip_to_dict(zip_path)
-    
-    # 通过标题段落查找表格
-    env_table = find_table_by_title(doc, "二、环境保护")
-    general_table = find_table_by_title(doc, "一、本期存在主要问题")
-    major_table = find_table_by_title(doc, "三、重大事故隐患检查情况")
-    
-    # 初始化计数器
-    env_counter = 0
-    general_counter = 0
-    major_counter = 0
-    
-    # 处理每一行数据
-    for index, row in df.iterrows():
-        # 检查异常类别是否为"环境保护"
-        if str(row.get('异常类别', '')) == '环境保护':
-            if env_table:
-                env_counter += 1
-                add_row_to_table_with_images_from_both_zip(env_table, row, env_counter, folder_images)
-        
-        # 检查隐患级别是否为"一般隐患"且异常类别不为"环境保护"
-        if str(row.get('隐患级别', '')) == '一般隐患' and str(row.get('异常类别', '')) != '环境保护':
-            if general_table:
-                general_counter += 1
-                add_row_to_table_with_images_from_both_zip(general_table, row, general_counter, folder_images)
-        
-        # 检查隐患级别是否为"重大隐患"且异常类别不为"环境保护"
-        if str(row.get('隐患级别', '')) == '重大隐患' and str(row.get('异常类别', '')) != '环境保护':
-            if major_table:
-                major_counter += 1
-                add_row_to_table_with_images_from_both_zip(major_table, row, major_counter, folder_images)
-    
-    # 如果环境保护表格为空，添加一行说明
-    if env_table and env_counter == 0:
-        new_row = env_table.add_row()
-        cells = new_row.cells
-        if len(cells) >= 9:  # 确保表格有足够的列
-            cells[0].text = "1"
-            cells[1].text = "本次检查未发现公司存在环境保护相关问题"
-            # 填充其余列
-            for i in range(2, len(cells)):
-                cells[i].text = "/"
-    
-    # 如果重大事故隐患检查情况表格为空，添加一行说明
-    if major_table and major_counter == 0:
-        new_row = major_table.add_row()
-        cells = new_row.cells
-        if len(cells) >= 9:  # 确保表格有足够的列
-            cells[0].text = "1"
-            cells[1].text = "根据《重大事故隐患清单》逐一排查，发现公司未存在重大事故隐患。"
-            # 填充其余列
-            for i in range(2, len(cells)):
-                cells[i].text = "/"
+    with profile_stage(profiler, "加载模板"):
+        doc, tables, columns = load_report_template(doc_template_path)
     
-    # 为所有表格设置格式
-    if env_table:
-        apply_table_formatting(env_table)
-    if general_table:
-        apply_table_formatting(general_table)
-    if major_table:
-        apply_table_formatting(major_table)
+    # 按异常类别和隐患级别判断每行所属表格，跳过模板中不存在的表格
+    with profile_stage(profiler, "数据行分类"):
+        classified = classify_report_rows(records, tables)
+    if profiler is not None:
+        profiler.info.update(rows=len(records), report_rows=len(classified))
+
+    # 逐行写入前先从压缩包按需读取并集中转码所需图片
+    with open_photo_index(zip_path) as photo_index:
+        prepared = prepare_photos(photo_index, report_photo_requests(classified, photo_folders), workers, cache, resample, profile, target_mb,
+                                  progress=progress, profiler=profiler, reuse=run)
+
+    fill_report(doc, tables, classified, prepared, photo_folders, columns, progress, profiler)
     
     # 保存文档
-    doc.save(output_path)
+    report_progress(progress, "保存文件", 0, 0)
+    with profile_stage(profiler, "保存文件"):
+        save_document(doc, output_path)
+
+def generate_check_report(excel_path, doc_template_path, zip_path, output_path, workers=None, cache=None, resample=None, profile=None, target_mb=None,
+                          progress=None, profiler=None, incremental=None, shard_by=None, processes=None):
+    """
+    生成检查报告；shard_by 不为 None 时分册输出（见 _generate_sharded_report），返回分册文件列表
+    """
+    return _generate_report(excel_path, doc_template_path, zip_path, output_path, CHECK_REPORT_PHOTOS, workers, cache, resample, profile,
+                            target_mb, progress, profiler, incremental, shard_by, processes)
+
+def generate_closure_report(excel_path, doc_template_path, zip_path, output_path, workers=None, cache=None, resample=None, profile=None, target_mb=None,
+                            progress=None, profiler=None, incremental=None, shard_by=None, processes=None):
+    """
+    生成闭环报告；shard_by 不为 None 时分册输出（见 _generate_sharded_report），返回分册文件列表
+    """
+    return _generate_report(excel_path, doc_template_path, zip_path, output_path, CLOSURE_REPORT_PHOTOS, workers, cache, resample, profile,
+                            target_mb, progress, profiler, incremental, shard_by, processes)
+
+# 报告按此列分册（每个班组一册）；shard_by 为正整数时改为每若干条隐患一册
+REPORT_SHARD_COLUMN = "班组"
+# 分册文件名中不能使用的字符
+INVALID_FILENAME_CHARS = '\\/:*?"<>|'
+# 班组为空的数据行所在分册的名称
+SHARD_BLANK_TEAM = "未分班组"
+
+def shard_report_rows(classified, shard_by):
+    """
+    将 classify_report_rows 的结果拆分为分册，返回 [(分册名, 数据行列表)]，各分册内保持原有行顺序
+    shard_by 为 REPORT_SHARD_COLUMN 时按班组拆分（按班组首次出现的顺序，空班组归入 SHARD_BLANK_TEAM，
+    与名为 SHARD_BLANK_TEAM 的班组分开成册），为正整数时每 shard_by 条一册
+    """
+    if shard_by == REPORT_SHARD_COLUMN:
+        column = REPORT_TEXT_COLUMNS.index(REPORT_SHARD_COLUMN)
+        shards = {}
+        for row in classified:
+            shards.setdefault(row[1].texts[column].strip() or None, []).append(row)
+        return [(team or SHARD_BLANK_TEAM, rows) for team, rows in shards.items()]
+    if isinstance(shard_by, int) and not isinstance(shard_by, bool) and shard_by > 0:
+        count = (len(classified) + shard_by - 1) // shard_by
+        width = len(str(count))
+        return [(f"第{i + 1:0{width}d}册", classified[i * shard_by:(i + 1) * shard_by]) for i in range(count)]
+    raise ValueError(f"分册方式应为 \"{REPORT_SHARD_COLUMN}\" 或正整数: {shard_by!r}")
+
+def shard_output_path(output_path, label):
+    """分册文件路径：输出文件名后加分册名，分册名中不能用于文件名的字符替换为下划线"""
+    label = "".join("_" if ch in INVALID_FILENAME_CHARS else ch for ch in label)
+    stem, ext = os.path.splitext(output_path)
+    return f"{stem}_{label}{ext}"
+
+def shard_output_paths(output_path, labels):
+    """
+    各分册的文件路径（见 shard_output_path），替换字符后重名的分册（如“A/B”和“A_B”）依次加 _2、_3……
+    按不区分大小写比较，Windows 上同样不会重名
+    """
+    paths = []
+    used = set()
+    for label in labels:
+        path = shard_output_path(output_path, label)
+        stem, ext = os.path.splitext(path)
+        serial = 1
+        while path.lower() in used:
+            serial += 1
+            path = f"{stem}_{serial}{ext}"
+        used.add(path.lower())
+        paths.append(path)
+    return paths
+
+def _build_report_shard(doc_template_path, zip_path, output_path, photo_folders, classified, workers, cache, resample, profile,
+                        target_mb, empty_notes=None):
+    """分册进程任务：由模板生成一份只含 classified 中数据行的报告，empty_notes 见 fill_report"""
+    doc, tables, columns = load_report_template(doc_template_path)
+    with open_photo_index(zip_path) as photo_index:
+        prepared = prepare_photos(photo_index, report_photo_requests(classified, photo_folders), workers, cache, resample, profile,
+                                  target_mb)
+    fill_report(doc, tables, classified, prepared, photo_folders, columns, empty_notes=empty_notes)
+    save_document(doc, output_path)
+
+def write_shard_index(index_path, title, shards):
+    """写出分册目录文档：每个分册一行，列出文件名和各表格的条数；shards 为 [(分册名, 分册文件路径, 数据行列表)]"""
+    from docx import Document
+
+    doc = Document()
+    doc.add_heading(f"{title}分册目录", level=1)
+    total = sum(len(rows) for label, path, rows in shards)
+    doc.add_paragraph(f"共 {len(shards)} 个分册、{total} 条隐患，生成时间 {datetime.now():%Y-%m-%d %H:%M}")
+
+    headers = ["序号", "分册", "文件名"] + [REPORT_SECTION_TITLES[section] for section in ("general", "env", "major")] + ["合计"]
+    table = doc.add_table(rows=1, cols=len(headers))
+    table.style = "Table Grid"
+    for cell, text in zip(table.rows[0].cells, headers):
+        cell.text = text
+    for serial, (label, path, rows) in enumerate(shards, start=1):
+        counts = {"env": 0, "general": 0, "major": 0}
+        for section, record in rows:
+            counts[section] += 1
+        values = [str(serial), label, os.path.basename(path)] + [str(counts[section]) for section in ("general", "env", "major")]
+        for cell, text in zip(table.add_row().cells, values + [str(len(rows))]):
+            cell.text = text
+    apply_table_formatting(table)
+    save_document(doc, index_path)
+
+def _generate_sharded_report(excel_path, doc_template_path, zip_path, output_path, photo_folders, shard_by, processes,
+                             workers, cache, resample, profile, target_mb, progress, profiler):
+    """
+    分册生成报告：按 shard_by 拆分数据行（见 shard_report_rows），每个分册由模板单独生成一份文档，
+    文件名为输出文件名后加分册名；output_path 处写出列出各分册的目录文档。返回分册文件列表
+    分册在 processes 个进程中并行生成（默认等于 CPU 核心数），并行时每个分册内部默认串行转码，避免进程数相乘；
+    多份分册用到的同一张图片经缩略图缓存复用。分册输出不做增量生成
+    中止或出错时删除本次已写出的分册
+    """
+    with profile_stage(profiler, "读取台账"):
+        records = read_ledger(excel_path)
+    with profile_stage(profiler, "加载模板"):
+        doc, tables, columns = load_report_template(doc_template_path)
+    with profile_stage(profiler, "数据行分类"):
+        classified = classify_report_rows(records, tables)
+        labelled = shard_report_rows(classified, shard_by)
+        shards = [(label, path, rows) for (label, rows), path in
+                  zip(labelled, shard_output_paths(output_path, [label for label, rows in labelled]))]
+    # 整份台账中有数据行的表格，分册中为空时只说明本分册没有，不能写出针对全公司的“未发现”结论
+    present = {section for section, record in classified}
+    empty_notes = {section: SHARD_EMPTY_NOTE for section in REPORT_EMPTY_NOTES if section in present}
+    if profiler is not None:
+        profiler.info.update(rows=len(records), shards=len(shards))
+
+    processes = processes or os.cpu_count() or 1
+    if processes > 1 and len(shards) > 1 and workers is None:
+        workers = 1
+    written = []
+    try:
+        with profile_stage(profiler, "生成分册"):
+            report_progress(progress, "生成分册", 0, len(shards))
+            if processes <= 1 or len(shards) <= 1:
+                for done, (label, path, rows) in enumerate(shards, start=1):
+                    _build_report_shard(doc_template_path, zip_path, path, photo_folders, rows, workers, cache, resample, profile,
+                                        target_mb, empty_notes)
+                    written.append(path)
+                    report_progress(progress, "生成分册", done, len(shards))
+            else:
+                pool = ProcessPoolExecutor(max_workers=min(processes, len(shards)))
+                futures = {}
+                try:
+                    for label, path, rows in shards:
+                        futures[pool.submit(_build_report_shard, doc_template_path, zip_path, path, photo_folders, rows, workers,
+                                            cache, resample, profile, target_mb, empty_notes)] = path
+                    pending = set(futures)
+                    while pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                        report_progress(progress, "生成分册", len(shards) - len(pending), len(shards))
+                finally:
+                    # 中止时不再启动排队的分册，等待正在生成的分册结束，以便清理它们写出的文件
+                    pool.shutdown(cancel_futures=True)
+                    written = [path for future, path in futures.items()
+                               if future.done() and not future.cancelled() and future.exception() is None]
+
+        report_progress(progress, "保存文件", 0, 0)
+        with profile_stage(profiler, "写出分册目录"):
+            write_shard_index(output_path, "检查报告" if tuple(photo_folders) == CHECK_REPORT_PHOTOS else "闭环报告", shards)
+    except BaseException:
+        for path in written:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        raise
+    if profiler is not None:
+        profiler.write(output_path)
+    return [path for label, path, rows in shards]
+
+def generate_all(excel_path, zip_path, check_template_path, closure_template_path,
+                 excel_output_path, check_output_path, closure_output_path,
+                 workers=None, cache=None, resample=None, profile=None, target_mb=None, streaming=None, progress=None,
+                 profiler=None, incremental=None, shard_by=None, processes=None):
+    """
+    一次性生成带图片台账、检查报告和闭环报告
+    三份输出的图片合并后一次转码，每张图片只从压缩包读取和转码一次，三份输出共用转码结果
+    台账读取两次：写出带图片台账时按原样加载（保留公式）；报告数据由 read_ledger 以只读、公式取缓存结果的方式读取第一个工作表，
+    与单独生成报告的结果一致。增量生成时另需计算台账文件的哈希
+    检查报告或闭环报告的模板为 None 时跳过对应报告
+    streaming 为 True 时台账改为流式写出（None 时按 EXCEL_STREAMING），报告所需图片另行转码，重复图片经缩略图缓存复用
+    progress 为进度回调，可抛出 GenerationCancelled 中止生成
+    profiler 为 PerfProfiler 时记录各阶段耗时，完成后在台账输出文件旁写出性能剖析报告
+    incremental 为 None 时按 INCREMENTAL 决定是否增量生成，三份输出各有清单，任何一份的图片都可复用
+    shard_by 不为 None 时报告分册输出（见 _generate_sharded_report），报告输出路径处为分册目录
+    返回台账图片插入的错误列表
+    """
+    if streaming is None:
+        streaming = EXCEL_STREAMING
+    if shard_by is not None:
+        # 台账单独生成，各分册在分册进程中转码，台账已转码的图片经缩略图缓存复用
+        errors = embed_images_to_excel(excel_path, zip_path, excel_output_path, workers, cache, resample, profile, target_mb,
+                                       streaming, progress, profiler, incremental)
+        for template_path, output_path, photo_folders in (
+                (check_template_path, check_output_path, CHECK_REPORT_PHOTOS),
+                (closure_template_path, closure_output_path, CLOSURE_REPORT_PHOTOS)):
+            if template_path:
+                _generate_sharded_report(excel_path, template_path, zip_path, output_path, photo_folders, shard_by, processes,
+                                         workers, cache, resample, profile, target_mb, progress, profiler)
+        if profiler is not None:
+            profiler.write(excel_output_path)
+        return errors
+
+    outputs = {excel_output_path: output_settings("excel", resample, profile, target_mb, streaming=streaming)}
+    for template_path, output_path, photo_folders in (
+            (check_template_path, check_output_path, CHECK_REPORT_PHOTOS),
+            (closure_template_path, closure_output_path, CLOSURE_REPORT_PHOTOS)):
+        if template_path:
+            outputs[output_path] = output_settings(f"report:{','.join(photo_folders)}", resample, profile, target_mb, template_path)
+    run = start_incremental_run(incremental, excel_path, zip_path, outputs, progress, profiler)
+    if run is not None and run.unchanged():
+        errors = run.errors(excel_output_path)
+    else:
+        with run or nullcontext():
+            if streaming:
+                errors = stream_excel_images(excel_path, zip_path, excel_output_path, workers, cache, resample, profile, target_mb,
+                                             progress=progress, profiler=profiler, reuse=run)
+                ws, keys = None, []
+            else:
+                with profile_stage(profiler, "读取台账"):
+                    wb, ws, keys = load_ledger_sheet(excel_path)
+                if profiler is not None:
+                    profiler.info.update(rows=len(keys), streaming=False)
+
+            reports = []
+            for template_path, output_path, photo_folders in (
+                    (check_template_path, check_output_path, CHECK_REPORT_PHOTOS),
+                    (closure_template_path, closure_output_path, CLOSURE_REPORT_PHOTOS)):
+                if template_path:
+                    if not reports:
+                        with profile_stage(profiler, "读取台账"):
+                            # 与单独生成报告一样用 read_ledger 读取第一个工作表、公式取缓存的计算结果；
+                            # 已加载的工作簿未按 data_only 加载，公式单元格读到的是公式本身
+                            records = read_ledger(excel_path)
+                    with profile_stage(profiler, "加载模板"):
+                        doc, tables, columns = load_report_template(template_path)
+                    with profile_stage(profiler, "数据行分类"):
+                        classified = classify_report_rows(records, tables)
+                    reports.append((doc, tables, columns, classified, output_path, photo_folders))
+
+            # 所有输出所需图片合并后一次转码
+            wanted = excel_photo_requests(keys)
+            for doc, tables, columns, classified, output_path, photo_folders in reports:
+                wanted += report_photo_requests(classified, photo_folders)
+            with open_photo_index(zip_path) as photo_index:
+                prepared = prepare_photos(photo_index, wanted, workers, cache, resample, profile, target_mb, progress=progress,
+                                          profiler=profiler, reuse=run)
+
+            if not streaming:
+                with profile_stage(profiler, "插入图片"):
+                    errors = fill_excel_images(ws, keys, prepared, progress)
+                report_progress(progress, "保存文件", 0, 0)
+                with profile_stage(profiler, "保存文件"):
+                    save_workbook(wb, excel_output_path)
+
+            for doc, tables, columns, classified, output_path, photo_folders in reports:
+                fill_report(doc, tables, classified, prepared, photo_folders, columns, progress, profiler)
+                report_progress(progress, "保存文件", 0, 0)
+                with profile_stage(profiler, "保存文件"):
+                    save_document(doc, output_path)
+
+            if run is not None:
+                run.save(excel_output_path, None, errors)
+                for doc, tables, columns, classified, output_path, photo_folders in reports:
+                    run.save(output_path, report_photo_requests(classified, photo_folders))
+
+    if profiler is not None:
+        profiler.write(excel_output_path)
+    return errors
+
+def classify_report_rows(records, tables):
+    """
+    判断每条隐患所属表格，按原有行顺序返回 (表格类别, HazardRecord) 列表
+    表格类别为 "env"（环境保护）、"general"（一般隐患）或 "major"（重大隐患），模板中不存在的表格跳过
+    """
+    classified = []
+    for record in records:
+        # 异常类别为"环境保护"优先，其余按隐患级别区分一般隐患和重大隐患
+        if record.category == '环境保护':
+            section = "env"
+        elif record.level == '一般隐患':
+            section = "general"
+        elif record.level == '重大隐患':
+            section = "major"
+        else:
+            continue
+        if tables[section]:
+            classified.append((section, record))
+    return classified
 
 def find_table_by_title(doc, title_text):
     """
@@ -317,158 +2099,649 @@ def find_column_index(table, header_text):
                 return i
     return -1
 
-def add_row_to_table_with_images_from_zip(table, row, serial_number, folder_images, photo_folder):
-    """向表格添加一行数据并插入图片（检查报告）"""
-    new_row = table.add_row()
-    cells = new_row.cells
-    
-    # 第一列填充序号
-    cells[0].text = str(serial_number)
-    
-    # 填充数据 - 根据实际列名映射
-    cells[1].text = str(row.get('异常事项', '')) if pd.notna(row.get('异常事项', '')) else ""
-    cells[2].text = str(row.get('异常类别', '')) if pd.notna(row.get('异常类别', '')) else ""
-    cells[3].text = str(row.get('班组', '')) if pd.notna(row.get('班组', '')) else ""
-    cells[4].text = str(row.get('整改人', '')) if pd.notna(row.get('整改人', '')) else ""
-    cells[5].text = str(row.get('发现时间', '')) if pd.notna(row.get('发现时间', '')) else ""
-    cells[6].text = str(row.get('要求闭环时间', '')) if pd.notna(row.get('要求闭环时间', '')) else ""
-    
-    # 查找隐患照片列的索引
-    hazard_photo_col = find_column_index(table, "隐患照片")
-    
-    # 插入隐患照片
-    if hazard_photo_col != -1 and str(row.get('隐患编号', '')) in folder_images[photo_folder]:
-        try:
-            # 清空单元格文本
-            cells[hazard_photo_col].text = ""
-            # 获取图片数据
-            hazard_id = str(row.get('隐患编号', ''))
-            img_data = folder_images[photo_folder][hazard_id]
-            pil_img = PILImage.open(io.BytesIO(img_data))
-            pil_img = pil_img.resize((IMG_WIDTH_PX, IMG_HEIGHT_PX), PILImage.LANCZOS)
-            if pil_img.mode in ("RGBA", "P"):
-                pil_img = pil_img.convert("RGB")
-            img_buffer = io.BytesIO()
-            pil_img.save(img_buffer, format='JPEG', dpi=(600, 600), quality=95)
-            img_buffer.seek(0)
-            # 插入图片
-            run = cells[hazard_photo_col].paragraphs[0].add_run()
-            # 图片尺寸：3.5cm x 5cm
-            run.add_picture(img_buffer, width=Inches(1.97), height=Inches(1.38))  # 5cm=1.97英寸, 3.5cm=1.38英寸
-        except Exception as e:
-            cells[hazard_photo_col].text = ""
-    elif hazard_photo_col != -1:
-        cells[hazard_photo_col].text = ""
-
-def add_row_to_table_with_images_from_both_zip(table, row, serial_number, folder_images):
-    """向表格添加一行数据并插入两种图片（闭环报告）"""
-    new_row = table.add_row()
-    cells = new_row.cells
-    
-    # 第一列填充序号
-    cells[0].text = str(serial_number)
-    
-    # 填充数据 - 根据实际列名映射
-    cells[1].text = str(row.get('异常事项', '')) if pd.notna(row.get('异常事项', '')) else ""
-    cells[2].text = str(row.get('异常类别', '')) if pd.notna(row.get('异常类别', '')) else ""
-    cells[3].text = str(row.get('班组', '')) if pd.notna(row.get('班组', '')) else ""
-    cells[4].text = str(row.get('整改人', '')) if pd.notna(row.get('整改人', '')) else ""
-    cells[5].text = str(row.get('发现时间', '')) if pd.notna(row.get('发现时间', '')) else ""
-    cells[6].text = str(row.get('要求闭环时间', '')) if pd.notna(row.get('要求闭环时间', '')) else ""
-    
-    # 查找隐患照片列和闭环照片列的索引
-    hazard_photo_col = find_column_index(table, "隐患照片")
-    close_photo_col = find_column_index(table, "闭环照片")
-    
-    hazard_id = str(row.get('隐患编号', ''))
-    
-    # 插入隐患照片
-    if hazard_photo_col != -1 and hazard_id in folder_images["隐患照片"]:
-        try:
-            # 清空单元格文本
-            cells[hazard_photo_col].text = ""
-            # 获取图片数据
-            img_data = folder_images["隐患照片"][hazard_id]
-            pil_img = PILImage.open(io.BytesIO(img_data))
-            pil_img = pil_img.resize((IMG_WIDTH_PX, IMG_HEIGHT_PX), PILImage.LANCZOS)
-            if pil_img.mode in ("RGBA", "P"):
-                pil_img = pil_img.convert("RGB")
-            img_buffer = io.BytesIO()
-            pil_img.save(img_buffer, format='JPEG', dpi=(600, 600), quality=95)
-            img_buffer.seek(0)
-            # 插入图片
-            run = cells[hazard_photo_col].paragraphs[0].add_run()
-            # 图片尺寸：3.5cm x 5cm
-            run.add_picture(img_buffer, width=Inches(1.97), height=Inches(1.38))  # 5cm=1.97英寸, 3.5cm=1.38英寸
-        except Exception as e:
-            cells[hazard_photo_col].text = ""
-    elif hazard_photo_col != -1:
-        cells[hazard_photo_col].text = ""
-    
-    # 插入闭环照片
-    if close_photo_col != -1 and hazard_id in folder_images["闭环照片"]:
-        try:
+class ReportTableWriter:
+    """
+    报告表格的批量写入器：只分析一次模板表格（列数、照片列位置、空白行原型），之后克隆原型行填充数据，最后一次性追加到表格
+    python-docx 的 table.add_row() 和 row.cells 每次都要重新计算整张表格的单元格网格，查找照片列也要重读表头，行数多时越写越慢
+    原型行的段落和文字格式预先设置好，新行不再需要事后逐个单元格补格式，模板原有的表头行在创建写入器时格式化一次
+    """
+    def __init__(self, table, photo_folders, images, columns=None):
+        from docx.oxml import OxmlElement
+        from docx.text.paragraph import Paragraph
+        from docx.text.run import Run
+
+        self.table = table
+        self.images = images
+        # 照片文件夹名与表头列名相同，模板中没有的照片列跳过；columns 为编译模板时已查好的列位置
+        if columns is None:
+            columns = {folder: find_column_index(table, folder) for folder in photo_folders}
+        self.photo_columns = [(folder, columns[folder]) for folder in photo_folders if columns[folder] != -1]
+        # 模板原有的行（表头）只需格式化一次
+        apply_table_formatting(table)
+        # 与 table.add_row() 生成的新行相同：每个网格列一个单元格，宽度取自网格列，段落预先居中
+        self._prototype = OxmlElement("w:tr")
+        for grid_col in table._tbl.tblGrid.gridCol_lst:
+            tc = self._prototype.add_tc()
+            if grid_col.w is not None:
+                tc.width = grid_col.w
+            format_paragraph(Paragraph(tc.p_lst[0], None))
+        # 已设置好字体的文字块原型，写入文字或图片时克隆
+        self._run_prototype = OxmlElement("w:r")
+        format_run(Run(self._run_prototype, None))
+        self._pending = []
+
+    def add_row(self):
+        """克隆一行空白行，返回其 w:tc 单元格元素列表，调用 flush 后才追加到表格"""
+        from copy import deepcopy
+
+        tr = deepcopy(self._prototype)
+        self._pending.append(tr)
+        return tr.tc_lst
+
+    def _new_run(self):
+        from copy import deepcopy
+
+        return deepcopy(self._run_prototype)
+
+    def set_text(self, tc, text):
+        """设置单元格文字，效果等同 cell.text = text 后再应用表格格式"""
+        p = tc.p_lst[0]
+        for r in p.r_lst:
+            p.remove(r)
+        r = self._new_run()
+        r.text = text
+        p.append(r)
+
+    def add_record(self, serial_number, record, prepared):
+        """写入一条隐患数据并插入对应照片，record 为 classify_report_rows 给出的 HazardRecord"""
+        from docx.shared import Inches
+
+        hazard_id, texts = record.hazard_id, record.texts
+        cells = self.add_row()
+        
+        # 第一列填充序号
+        self.set_text(cells[0], str(serial_number))
+        
+        # 填充数据 - 异常事项、异常类别、班组、整改人、发现时间、要求闭环时间
+        for col, text in enumerate(texts, start=1):
+            self.set_text(cells[col], text)
+        
+        # 插入隐患照片 / 闭环照片
+        for folder, col in self.photo_columns:
             # 清空单元格文本
-            cells[close_photo_col].text = ""
-            # 获取图片数据
-            img_data = folder_images["闭环照片"][hazard_id]
-            pil_img = PILImage.open(io.BytesIO(img_data))
-            pil_img = pil_img.resize((IMG_WIDTH_PX, IMG_HEIGHT_PX), PILImage.LANCZOS)
-            if pil_img.mode in ("RGBA", "P"):
-                pil_img = pil_img.convert("RGB")
-            img_buffer = io.BytesIO()
-            pil_img.save(img_buffer, format='JPEG', dpi=(600, 600), quality=95)
-            img_buffer.seek(0)
-            # 插入图片
-            run = cells[close_photo_col].paragraphs[0].add_run()
-            # 图片尺寸：3.5cm x 5cm
-            run.add_picture(img_buffer, width=Inches(1.97), height=Inches(1.38))  # 5cm=1.97英寸, 3.5cm=1.38英寸
-        except Exception as e:
-            cells[close_photo_col].text = ""
-    elif close_photo_col != -1:
-        cells[close_photo_col].text = ""
+            self.set_text(cells[col], "")
+            if (folder, hazard_id) not in prepared:
+                continue
+            try:
+                # 获取预先转码的图片数据
+                img_data = photo_data(prepared, folder, hazard_id)
+                # 插入图片（内容相同的图片共用一个媒体文件），成功后才放入单元格
+                r = self._new_run()
+                # 图片尺寸：3.5cm x 5cm
+                self.images.add_picture(r, img_data, width=Inches(1.97), height=Inches(1.38))  # 5cm=1.97英寸, 3.5cm=1.38英寸
+                cells[col].p_lst[0].append(r)
+            except Exception as e:
+                pass
+
+    def add_note_row(self, note, min_cols):
+        """为空表格添加一行说明，其余列填 "/"，表格列数不足 min_cols 时只留空行"""
+        cells = self.add_row()
+        if len(cells) >= min_cols:  # 确保表格有足够的列
+            self.set_text(cells[0], "1")
+            self.set_text(cells[1], note)
+            # 填充其余列
+            for i in range(2, len(cells)):
+                self.set_text(cells[i], "/")
+
+    def flush(self):
+        """把已生成的行一次性追加到表格末尾"""
+        self.table._tbl.extend(self._pending)
+        self._pending = []
+
+def format_paragraph(paragraph):
+    """报告表格的段落格式：居中"""
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+
+    paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+def format_run(run):
+    """报告表格的文字格式：仿宋、四号、加粗"""
+    from docx.shared import Pt
+    from docx.oxml.ns import qn
+
+    # 设置字体为仿宋，四号字
+    run.font.name = '仿宋'
+    run.font.size = Pt(14)  # 四号字约等于14磅
+    # 设置加粗
+    run.font.bold = True
+    # 设置中文字体
+    if hasattr(run._element, 'rPr') and run._element.rPr is not None:
+        if run._element.rPr.rFonts is not None:
+            run._element.rPr.rFonts.set(qn('w:eastAsia'), '仿宋')
 
 def apply_table_formatting(table):
-    """为表格应用格式"""
+    """为表格已有的行应用格式"""
     for row in table.rows:
         for cell in row.cells:
             # 设置单元格内的所有段落格式
             for paragraph in cell.paragraphs:
-                # 设置段落居中
-                paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+                format_paragraph(paragraph)
                 for run in paragraph.runs:
-                    # 设置字体为仿宋，四号字
-                    run.font.name = '仿宋'
-                    run.font.size = Pt(14)  # 四号字约等于14磅
-                    # 设置加粗
-                    run.font.bold = True
-                    # 设置中文字体
-                    if hasattr(run._element, 'rPr') and run._element.rPr is not None:
-                        if run._element.rPr.rFonts is not None:
-                            run._element.rPr.rFonts.set(qn('w:eastAsia'), '仿宋')
-
-def extract_zip_to_dict(zip_path):
-    required_folders = {"隐患照片", "闭环照片"}
-    folder_images = {"隐患照片": {}, "闭环照片": {}}
-
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        all_files = zip_ref.namelist()
-        top_dirs = set(f.split('/')[0] for f in all_files if '/' in f)
-
-        # 初始化所需文件夹的字典，即使它们不存在于ZIP文件中
-        for folder in required_folders:
+                    format_run(run)
+
+class ZipPhotoIndex:
+    """
+    图片压缩包索引：一次遍历目录建立 {文件夹: {隐患编号: ZipInfo}}，图片数据按需读取
+    shared 为 True 时是常驻缓存中的索引，close() 不关闭压缩包
+    """
+    FOLDERS = ("隐患照片", "闭环照片")
+
+    def __init__(self, zip_path):
+        self.zip_path = zip_path
+        self.shared = False
+        self.folders = {folder: {} for folder in self.FOLDERS}
+        self._zip = zipfile.ZipFile(zip_path, 'r')
+
+        top_dirs = set()
+        for info in self._zip.infolist():
+            top_dir, sep, rest = info.filename.partition('/')
+            if not sep:
+                continue
+            top_dirs.add(top_dir)
+            if top_dir in self.folders and not info.filename.endswith('/'):
+                key = os.path.splitext(os.path.basename(info.filename))[0]
+                self.folders[top_dir][key] = info
+
+        for folder in self.FOLDERS:
             if folder not in top_dirs:
                 print(f"警告: ZIP 中缺少 '{folder}' 文件夹，将跳过相关处理。")
-                continue  # 跳过不存在的文件夹
 
-            for f in all_files:
-                if f.startswith(folder + '/') and not f.endswith('/'):
-                    filename = os.path.basename(f)
-                    key = os.path.splitext(filename)[0]
-                    with zip_ref.open(f) as img_file:
-                        folder_images[folder][key] = img_file.read()
+    def read(self, folder, key):
+        """读取指定图片的原始数据"""
+        return self._zip.read(self.folders[folder][key])
+
+    def close(self, force=False):
+        if force or not self.shared:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# 批量处理（命令行，无需图形界面）
+def discover_batch_jobs(root_dir):
+    """
+    扫描目录下的每个子目录，每个子目录应包含一个台账 .xlsx 和一个图片压缩包 .zip
+    返回作业列表，无法确定台账或压缩包的子目录以 error 字段标出
+    """
+    jobs = []
+    for name in sorted(os.listdir(root_dir)):
+        job_dir = os.path.join(root_dir, name)
+        if not os.path.isdir(job_dir):
+            continue
+        files = sorted(os.listdir(job_dir))
+        # 跳过本工具生成的文件和 Excel 临时文件
+        excels = [f for f in files if f.endswith(".xlsx") and not f.endswith("_带图片.xlsx") and not f.startswith("~$")]
+        zips = [f for f in files if f.endswith(".zip")]
+        job = {"name": name}
+        if len(excels) == 1 and len(zips) == 1:
+            job["excel"] = os.path.join(job_dir, excels[0])
+            job["zip"] = os.path.join(job_dir, zips[0])
+        else:
+            job["error"] = f"目录中应有且仅有一个 .xlsx 台账和一个 .zip 压缩包（找到 {len(excels)} 个台账、{len(zips)} 个压缩包）"
+        jobs.append(job)
+    return jobs
+
+def load_batch_manifest(manifest_path):
+    """
+    读取 JSON 作业清单：[{"name": ..., "excel": ..., "zip": ..., "check_template": ..., "closure_template": ...}, ...]
+    模板可省略（使用命令行指定的模板），相对路径相对于清单文件所在目录
+    name 用作输出子目录名，含路径分隔符等不能用于文件名的字符或为 "." / ".." 时以 error 字段标出
+    """
+    with open(manifest_path, encoding="utf-8") as f:
+        entries = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    jobs = []
+    for i, entry in enumerate(entries, start=1):
+        job = {"name": str(entry.get("name") or f"job{i}")}
+        for field in ("excel", "zip", "check_template", "closure_template"):
+            if entry.get(field):
+                job[field] = os.path.join(base_dir, entry[field])
+        if job["name"] in (".", "..") or any(ch in INVALID_FILENAME_CHARS for ch in job["name"]):
+            # 名称直接用作输出子目录，不能指向输出目录以外
+            job["error"] = f"作业名称不能包含路径或字符 {INVALID_FILENAME_CHARS}: {job['name']}"
+        elif "excel" not in job or "zip" not in job:
+            job["error"] = "作业清单缺少 excel 或 zip 字段"
+        jobs.append(job)
+    return jobs
+
+def run_batch_job(job, output_dir, options):
+    """执行单个批量作业，返回包含状态、耗时、输出文件和图片错误的结果字典"""
+    result = {"name": job["name"], "status": "failed", "seconds": 0.0, "outputs": [], "errors": []}
+    if "error" in job:
+        result["message"] = job["error"]
+        return result
+
+    start = time.perf_counter()
+    try:
+        job_dir = os.path.join(output_dir, job["name"])
+        os.makedirs(job_dir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(job["excel"]))[0]
+        excel_output_path = os.path.join(job_dir, stem + "_带图片.xlsx")
+        check_template_path = job.get("check_template") or options.get("check_template")
+        closure_template_path = job.get("closure_template") or options.get("closure_template")
+        check_output_path = os.path.join(job_dir, job["name"] + "_检查报告.docx")
+        closure_output_path = os.path.join(job_dir, job["name"] + "_闭环报告.docx")
+
+        profiler = PerfProfiler() if options.get("perf_report") else None
+        result["errors"] = generate_all(job["excel"], job["zip"], check_template_path, closure_template_path,
+                                        excel_output_path, check_output_path, closure_output_path,
+                                        workers=options.get("workers"), cache=options.get("cache"),
+                                        resample=options.get("resample"), profile=options.get("profile"),
+                                        target_mb=options.get("target_mb"), streaming=options.get("streaming"),
+                                        profiler=profiler, incremental=options.get("incremental"),
+                                        shard_by=options.get("shard_by"), processes=options.get("shard_processes"))
+        if profiler is not None:
+            result["profile"] = excel_output_path + PROFILE_REPORT_SUFFIX
+        result["outputs"].append(excel_output_path)
+        if check_template_path:
+            result["outputs"].append(check_output_path)
+        if closure_template_path:
+            result["outputs"].append(closure_output_path)
+        result["status"] = "warning" if result["errors"] else "ok"
+    except Exception as e:
+        result["message"] = str(e)
+    result["seconds"] = round(time.perf_counter() - start, 3)
+    return result
+
+def run_batch(jobs, output_dir, options, processes=None):
+    """
+    用进程池并行执行多个作业，逐个打印完成状态，并在输出目录写入 batch_summary.json
+    并行执行多个作业时，每个作业内部默认串行转码、串行生成分册，避免进程数相乘
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    processes = processes or os.cpu_count() or 1
+    if processes > 1 and len(jobs) > 1:
+        if options.get("workers") is None:
+            options = dict(options, workers=1)
+        if options.get("shard_processes") is None:
+            options = dict(options, shard_processes=1)
+
+    status_text = {"ok": "成功", "warning": "完成（含警告）", "failed": "失败"}
+
+    def report(result):
+        line = f"[{status_text[result['status']]}] {result['name']}  {result['seconds']:.1f}s"
+        if result["errors"]:
+            line += f"  图片错误 {len(result['errors'])} 条"
+        if result.get("message"):
+            line += f"  {result['message']}"
+        print(line, flush=True)
+
+    start = time.perf_counter()
+    results = []
+    if processes <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            results.append(run_batch_job(job, output_dir, options))
+            report(results[-1])
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(jobs))) as pool:
+            futures = [pool.submit(run_batch_job, job, output_dir, options) for job in jobs]
+            for future in futures:
+                results.append(future.result())
+                report(results[-1])
 
-    return folder_images
+    summary = {
+        "seconds": round(time.perf_counter() - start, 3),
+        "jobs": results,
+    }
+    with open(os.path.join(output_dir, "batch_summary.json"), "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print(f"共 {len(results)} 个作业，失败 {sum(r['status'] == 'failed' for r in results)} 个，总耗时 {summary['seconds']:.1f}s")
+    return results
+
+# 本机常驻作业服务：进程常驻，多次生成之间保留常驻缓存，图形界面以外的脚本通过本机 HTTP 提交作业
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+# 服务中保留状态的已结束作业个数
+SERVER_JOB_HISTORY = 100
+# 客户端等待作业完成时查询状态的间隔（秒）
+SERVER_POLL_SECONDS = 0.5
+
+SERVER_JOB_KINDS = ("excel", "check", "closure", "all")
+# 各类作业的必填字段；all 作业给出报告模板时还须给出对应的报告输出路径
+SERVER_REQUIRED_FIELDS = {
+    "excel": ("excel", "zip", "output"),
+    "check": ("excel", "zip", "template", "output"),
+    "closure": ("excel", "zip", "template", "output"),
+    "all": ("excel", "zip", "excel_output"),
+}
+# 作业说明中的路径字段，客户端提交前转为绝对路径
+SERVER_PATH_FIELDS = ("excel", "zip", "template", "output", "check_template", "closure_template",
+                      "excel_output", "check_output", "closure_output")
+# 服务启动时生成随机令牌写入此目录（只有本用户可读），客户端每次请求在 SERVER_TOKEN_HEADER 中带上令牌；
+# 浏览器中的网页读不到令牌，也不能不经预检就发送自定义请求头，无法借用户的浏览器提交作业或停止服务
+SERVER_TOKEN_DIR = os.path.join(
+    os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "隐患整改台账与报告生成工具")
+SERVER_TOKEN_HEADER = "X-Job-Token"
+
+def server_token_path(port):
+    """端口 port 上作业服务的令牌文件"""
+    return os.path.join(SERVER_TOKEN_DIR, f"server-{port}.token")
+
+def read_server_token(port):
+    """读取作业服务的令牌，服务未启动时抛出 FileNotFoundError"""
+    with open(server_token_path(port), encoding="ascii") as f:
+        return f.read().strip()
+
+def check_job_spec(spec):
+    """检查作业说明的类型、必填字段和 cache 字段，不符合时抛出 ValueError（服务据此返回 400）"""
+    if not isinstance(spec, dict) or spec.get("kind") not in SERVER_JOB_KINDS:
+        raise ValueError(f"作业说明应为 JSON 对象，kind 为 {' / '.join(SERVER_JOB_KINDS)} 之一")
+    required = list(SERVER_REQUIRED_FIELDS[spec["kind"]])
+    if spec["kind"] == "all":
+        required += [output for template, output in (("check_template", "check_output"), ("closure_template", "closure_output"))
+                     if spec.get(template)]
+    missing = [field for field in required if not spec.get(field)]
+    if missing:
+        raise ValueError(f"{spec['kind']} 作业缺少字段: {', '.join(missing)}")
+    if not isinstance(spec.get("cache", True), bool):
+        raise ValueError(f"cache 应为 true 或 false: {spec['cache']!r}")
+
+def run_server_job(spec, progress=None, profiler=None):
+    """
+    按作业说明调用对应的生成函数，返回结果字典
+    spec 字段：kind（excel / check / closure / all）、excel、zip；
+    excel 作业用 output，check、closure 作业用 template（报告模板）和 output，all 作业用 check_template、closure_template、
+    excel_output、check_output、closure_output（必填字段见 SERVER_REQUIRED_FIELDS）；
+    可选 workers、cache（false 表示不用磁盘缓存，仍使用服务的内存缓存）、resample、profile、target_mb、streaming、
+    incremental、shard_by
+    """
+    check_job_spec(spec)
+    kind = spec["kind"]
+    cache = spec.get("cache", True)
+    options = {name: spec.get(name) for name in ("workers", "resample", "profile", "target_mb", "incremental")}
+    options["cache"] = None if cache else (memory_thumbnail_cache() or False)
+    if kind == "excel":
+        errors = embed_images_to_excel(spec["excel"], spec["zip"], spec["output"], streaming=spec.get("streaming"),
+                                       progress=progress, profiler=profiler, **options)
+        return {"errors": errors, "outputs": [spec["output"]]}
+    if kind in ("check", "closure"):
+        generate = generate_check_report if kind == "check" else generate_closure_report
+        shards = generate(spec["excel"], spec["template"], spec["zip"], spec["output"], progress=progress, profiler=profiler,
+                          shard_by=spec.get("shard_by"), **options)
+        return {"errors": [], "outputs": [spec["output"]] + (shards or [])}
+    errors = generate_all(spec["excel"], spec["zip"], spec.get("check_template"), spec.get("closure_template"),
+                          spec["excel_output"], spec.get("check_output"), spec.get("closure_output"),
+                          streaming=spec.get("streaming"), progress=progress, profiler=profiler,
+                          shard_by=spec.get("shard_by"), **options)
+    outputs = [spec["excel_output"]]
+    for template_field, output_field in (("check_template", "check_output"), ("closure_template", "closure_output")):
+        if spec.get(template_field):
+            outputs.append(spec[output_field])
+    return {"errors": errors, "outputs": outputs}
+
+_server_handler_class = None
+
+def _job_server_handler():
+    """首次启动服务时导入 http.server 并定义请求处理类"""
+    global _server_handler_class
+    if _server_handler_class is not None:
+        return _server_handler_class
+
+    from http.server import BaseHTTPRequestHandler
+
+    class _JobServerHandler(BaseHTTPRequestHandler):
+        """
+        GET  /status              服务和常驻缓存状态
+        POST /jobs                提交作业（请求体为 JSON 作业说明），返回作业状态
+        GET  /jobs/<id>           查询作业状态
+        POST /jobs/<id>/cancel    取消作业
+        POST /shutdown            停止服务
+        每个请求都须在 SERVER_TOKEN_HEADER 中带上服务令牌；带 Origin 头的请求（来自浏览器中的网页）一律拒绝，
+        POST 请求的 Content-Type 须为 application/json
+        """
+        def _reply(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self, method):
+            job_server = self.server.job_server
+            if self.headers.get("Origin") is not None:
+                return 403, {"error": "不接受来自网页的请求"}
+            if not hmac.compare_digest(self.headers.get(SERVER_TOKEN_HEADER, ""), job_server.token):
+                return 403, {"error": "缺少或错误的服务令牌"}
+            content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if method == "POST" and content_type != "application/json":
+                return 415, {"error": "请求体应为 application/json"}
+            parts = [part for part in self.path.split("?")[0].split("/") if part]
+            if method == "GET" and parts == ["status"]:
+                return 200, job_server.status()
+            if method == "POST" and parts == ["jobs"]:
+                length = int(self.headers.get("Content-Length") or 0)
+                try:
+                    spec = json.loads(self.rfile.read(length).decode("utf-8"))
+                    return 202, job_server.submit(spec)
+                except ValueError as e:
+                    return 400, {"error": str(e)}
+            if method == "POST" and parts == ["shutdown"]:
+                threading.Thread(target=job_server.shutdown, daemon=True).start()
+                return 200, {"status": "stopping"}
+            if len(parts) >= 2 and parts[0] == "jobs":
+                job = job_server.job(parts[1])
+                if job is None:
+                    return 404, {"error": f"作业不存在: {parts[1]}"}
+                if method == "GET" and len(parts) == 2:
+                    return 200, job
+                if method == "POST" and parts[2:] == ["cancel"]:
+                    return 200, job_server.cancel(parts[1])
+            return 404, {"error": f"未知的请求: {method} {self.path}"}
+
+        def do_GET(self):
+            self._reply(*self._route("GET"))
+
+        def do_POST(self):
+            self._reply(*self._route("POST"))
+
+        def log_message(self, format, *args):
+            # 只打印作业的开始和结束，不逐条打印请求
+            pass
+
+    _server_handler_class = _JobServerHandler
+    return _server_handler_class
+
+class JobServer:
+    """
+    本机常驻作业服务：只监听本机地址，后台线程按提交顺序逐个执行作业（与图形界面一样一次只做一件事，
+    转码由进程池并行），作业之间保留常驻缓存，连续生成时只需付出变化部分的代价
+    作业状态 status 依次为 queued、running，结束时为 ok、warning、failed 或 cancelled
+    """
+    def __init__(self, port=SERVER_PORT, caches=None):
+        from http.server import ThreadingHTTPServer
+
+        self.caches = caches or enable_warm_caches()
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.next_id = 1
+        self.started = time.time()
+        self.httpd = ThreadingHTTPServer((SERVER_HOST, port), _job_server_handler())
+        self.httpd.daemon_threads = True
+        self.httpd.job_server = self
+        self.port = self.httpd.server_address[1]
+        self.token = secrets.token_urlsafe(32)
+        self.token_path = server_token_path(self.port)
+        os.makedirs(SERVER_TOKEN_DIR, exist_ok=True)
+        if os.path.exists(self.token_path):
+            os.remove(self.token_path)
+        with os.fdopen(os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "w", encoding="ascii") as f:
+            f.write(self.token)
+
+    def submit(self, spec):
+        check_job_spec(spec)
+        with self.lock:
+            job_id = str(self.next_id)
+            self.next_id += 1
+            job = {"id": job_id, "kind": spec["kind"], "status": "queued", "progress": None, "seconds": 0.0,
+                   "errors": [], "outputs": [], "cancel": False}
+            self.jobs[job_id] = job
+            finished = [key for key, item in self.jobs.items() if item["status"] not in ("queued", "running")]
+            for key in finished[:max(0, len(finished) - SERVER_JOB_HISTORY)]:
+                del self.jobs[key]
+        self.queue.put((job, spec))
+        return self.job(job_id)
+
+    def job(self, job_id):
+        """返回作业状态的副本，不存在时返回 None"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return {key: value for key, value in job.items() if key != "cancel"} if job else None
+
+    def cancel(self, job_id):
+        """排队中的作业直接取消，运行中的作业在下一次报告进度时中止"""
+        with self.lock:
+            job = self.jobs[job_id]
+            job["cancel"] = True
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+        return self.job(job_id)
+
+    def status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"pid": os.getpid(), "uptime": round(time.time() - self.started, 1), "jobs": counts,
+                "caches": self.caches.stats(), "memory_mb": memory_usage_mb()}
+
+    def _run(self, job, spec):
+        def progress(stage, done, total):
+            if job["cancel"]:
+                raise GenerationCancelled()
+            job["progress"] = [stage, done, total]
+
+        with self.lock:
+            if job["status"] != "queued":
+                return
+            job["status"] = "running"
+        print(f"[开始] 作业 {job['id']}（{job['kind']}）", flush=True)
+        start = time.perf_counter()
+        profiler = PerfProfiler() if spec.get("perf_report") else None
+        try:
+            result = run_server_job(spec, progress, profiler)
+        except GenerationCancelled:
+            status, result = "cancelled", {}
+        except Exception as e:
+            status, result = "failed", {"message": str(e)}
+        else:
+            status = "warning" if result["errors"] else "ok"
+            if profiler is not None:
+                result["profile"] = result["outputs"][0] + PROFILE_REPORT_SUFFIX
+        with self.lock:
+            job.update(result, status=status, seconds=round(time.perf_counter() - start, 3))
+        print(f"[{status}] 作业 {job['id']}（{job['kind']}）  {job['seconds']:.1f}s", flush=True)
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._run(*item)
+
+    def serve_forever(self):
+        worker = threading.Thread(target=self._worker, daemon=True)
+        worker.start()
+        print(f"作业服务已启动：http://{SERVER_HOST}:{self.port}（按 Ctrl+C 停止）", flush=True)
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.queue.put(None)
+            worker.join()
+            self.httpd.server_close()
+            self.caches.close()
+            try:
+                os.remove(self.token_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """停止接受请求；正在执行的作业做完后 serve_forever 返回"""
+        self.httpd.shutdown()
+
+def server_request(method, path, payload=None, port=SERVER_PORT):
+    """
+    向本机作业服务发送请求，返回解析后的 JSON；服务返回错误时抛出 RuntimeError
+    令牌从服务写出的令牌文件读取，服务未启动时抛出 FileNotFoundError
+    """
+    import urllib.request
+    import urllib.error
+
+    data = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(f"http://{SERVER_HOST}:{port}{path}", data=data, method=method,
+                                     headers={"Content-Type": "application/json; charset=utf-8",
+                                              SERVER_TOKEN_HEADER: read_server_token(port)})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(json.loads(e.read().decode("utf-8")).get("error") or str(e)) from None
+
+def submit_job(spec, port=SERVER_PORT, wait=True, progress=None):
+    """
+    提交作业，wait 为 True 时等待作业结束并返回最终状态
+    progress 为进度回调，每次查询到新的进度时以 (阶段, 已完成, 总数) 调用
+    """
+    job = server_request("POST", "/jobs", spec, port)
+    last = None
+    try:
+        while wait and job["status"] in ("queued", "running"):
+            time.sleep(SERVER_POLL_SECONDS)
+            job = server_request("GET", f"/jobs/{job['id']}", port=port)
+            if progress is not None and job["progress"] and job["progress"] != last:
+                last = job["progress"]
+                progress(*last)
+    except KeyboardInterrupt:
+        # 等待中按 Ctrl+C 时一并取消服务中的作业
+        server_request("POST", f"/jobs/{job['id']}/cancel", port=port)
+        raise
+    return job
+
+def load_job_specs(spec_path):
+    """读取 JSON 作业说明（单个对象或列表），相对路径相对于说明文件所在目录"""
+    with open(spec_path, encoding="utf-8") as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [specs]
+    base_dir = os.path.dirname(os.path.abspath(spec_path))
+    for spec in specs:
+        for field in SERVER_PATH_FIELDS:
+            if spec.get(field):
+                spec[field] = os.path.join(base_dir, spec[field])
+    return specs
+
+def _import_tkinter():
+    """图形界面所需模块只在启动界面时导入，命令行模式不依赖 tkinter"""
+    global tk, filedialog, messagebox, ttk
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+
+# 界面轮询后台任务进度的间隔（毫秒）
+PROGRESS_POLL_MS = 100
+# 各处理阶段进度的计数单位
+PROGRESS_UNITS = {"转码图片": "张图片", "转码并写入台账": "张图片", "写入台账": "行", "写入报告": "行", "生成分册": "个分册"}
+
+def format_duration(seconds):
+    """把秒数格式化为“x 分 y 秒”"""
+    seconds = int(seconds + 0.5)
+    if seconds >= 60:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds} 秒"
 
 # GUI 应用
 class App:
@@ -481,8 +2754,19 @@ class App:
         self.check_report_template_path = ""
         self.closure_report_template_path = ""
         self.zip_path = ""
+
+        # 后台任务：生成在工作线程中执行，进度经队列传回主线程，对话框只在主线程弹出
+        self.worker = None
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.on_task_done = None
+        self.closing = False
+        self.stage = None
+        self.stage_start = 0.0
+        self.stage_done = 0
         
         self.setup_ui()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
     def setup_ui(self):
         frame = ttk.Frame(self.root, padding="20")
@@ -512,9 +2796,32 @@ class App:
         button_frame = ttk.Frame(frame)
         button_frame.grid(row=4, column=0, columnspan=2, pady=20)
 
-        ttk.Button(button_frame, text="隐患整改台账生成", command=self.generate_excel_report).pack(side=tk.LEFT, padx=5)
-        ttk.Button(button_frame, text="检查报告生成", command=self.generate_check_report).pack(side=tk.LEFT, padx=5)
-        ttk.Button(button_frame, text="闭环报告生成", command=self.generate_closure_report).pack(side=tk.LEFT, padx=5)
+        self.action_buttons = [
+            ttk.Button(button_frame, text="隐患整改台账生成", command=self.generate_excel_report),
+            ttk.Button(button_frame, text="检查报告生成", command=self.generate_check_report),
+            ttk.Button(button_frame, text="闭环报告生成", command=self.generate_closure_report),
+            ttk.Button(button_frame, text="全部生成", command=self.generate_all),
+        ]
+        for button in self.action_buttons:
+            button.pack(side=tk.LEFT, padx=5)
+
+        # 增量生成开关：勾选后复用上次输出中未变化的图片，台账和图片都未变化时直接沿用上次的输出
+        self.incremental = tk.BooleanVar(value=INCREMENTAL)
+        ttk.Checkbutton(frame, text="增量生成（复用上次的输出）", variable=self.incremental).grid(row=5, column=0, columnspan=2, sticky=tk.W)
+        # 报告分册开关：勾选后检查报告和闭环报告按班组分册，原输出文件改为分册目录
+        self.shard_by_team = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame, text="报告按班组分册", variable=self.shard_by_team).grid(row=6, column=0, columnspan=2, sticky=tk.W)
+        # 性能剖析开关：勾选后生成完成时在输出文件旁写出各阶段耗时和内存报告
+        self.perf_report = tk.BooleanVar(value=False)
+        ttk.Checkbutton(frame, text="记录性能剖析报告", variable=self.perf_report).grid(row=7, column=0, columnspan=2, sticky=tk.W)
+
+        # 进度区域：进度条、处理数量和预计剩余时间、取消按钮
+        self.progress_bar = ttk.Progressbar(frame, mode="determinate", maximum=100)
+        self.progress_bar.grid(row=8, column=0, columnspan=2, sticky=(tk.W, tk.E))
+        self.status_label = ttk.Label(frame, text="就绪")
+        self.status_label.grid(row=9, column=0, columnspan=2, pady=5, sticky=tk.W)
+        self.cancel_button = ttk.Button(frame, text="取消", command=self.cancel_task, state=tk.DISABLED)
+        self.cancel_button.grid(row=10, column=0, columnspan=2)
 
     def select_excel(self):
         path = filedialog.askopenfilename(filetypes=[("Excel files", "*.xlsx")])
@@ -540,58 +2847,324 @@ class App:
             self.zip_path = path
             self.zip_label.config(text=os.path.basename(path))
 
+    def run_task(self, task, on_done):
+        """
+        在后台线程中执行 task(progress, profiler)，界面保持响应
+        勾选了性能剖析时 profiler 为 PerfProfiler，否则为 None
+        完成后在主线程中调用 on_done(返回值)；出错或取消时在主线程中弹出提示
+        """
+        profiler = PerfProfiler() if self.perf_report.get() else None
+        self.cancel_event.clear()
+        self.on_task_done = on_done
+        self.stage = None
+        for button in self.action_buttons:
+            button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar.config(mode="indeterminate")
+        self.progress_bar.start()
+        self.status_label.config(text="正在读取文件...")
+
+        def progress(stage, done, total):
+            # 在工作线程中调用：检查是否已取消，进度交给主线程显示
+            if self.cancel_event.is_set():
+                raise GenerationCancelled()
+            self.events.put(("progress", stage, done, total))
+
+        def work():
+            try:
+                result = task(progress, profiler)
+            except GenerationCancelled:
+                self.events.put(("cancelled",))
+            except Exception as e:
+                self.events.put(("error", e))
+            else:
+                self.events.put(("done", result))
+
+        self.worker = threading.Thread(target=work, daemon=True)
+        self.worker.start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_task)
+
+    def poll_task(self):
+        """主线程定时取出后台任务的进度，任务结束后恢复界面并弹出结果"""
+        latest = None
+        finished = None
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "progress":
+                latest = event[1:]
+            else:
+                finished = event
+        if latest is not None and finished is None:
+            self.show_progress(*latest)
+        if finished is None:
+            self.root.after(PROGRESS_POLL_MS, self.poll_task)
+            return
+
+        self.worker = None
+        for button in self.action_buttons:
+            button.config(state=tk.NORMAL)
+        self.cancel_button.config(state=tk.DISABLED)
+        self.progress_bar.stop()
+        self.progress_bar.config(mode="determinate", value=0)
+        if self.closing:
+            self.root.destroy()
+            return
+
+        if finished[0] == "done":
+            self.status_label.config(text="完成")
+            self.on_task_done(finished[1])
+        elif finished[0] == "cancelled":
+            self.status_label.config(text="已取消")
+            messagebox.showinfo("已取消", "已取消生成，正在生成的文件未保存。")
+        else:
+            self.status_label.config(text="失败")
+            messagebox.showerror("严重错误", f"程序运行失败：\n{str(finished[1])}")
+
+    def show_progress(self, stage, done, total):
+        """显示当前阶段的处理数量和按本阶段平均速度估算的剩余时间"""
+        now = time.monotonic()
+        # 进入新阶段或同名阶段重新计数（如全部生成时的第二份报告）时重新计时
+        if stage != self.stage or done < self.stage_done:
+            self.stage, self.stage_start = stage, now
+        self.stage_done = done
+        if total <= 0:
+            if str(self.progress_bar.cget("mode")) != "indeterminate":
+                self.progress_bar.config(mode="indeterminate")
+                self.progress_bar.start()
+            self.status_label.config(text=f"{stage}...")
+            return
+
+        if str(self.progress_bar.cget("mode")) != "determinate":
+            self.progress_bar.stop()
+            self.progress_bar.config(mode="determinate")
+        self.progress_bar.config(value=done * 100 / total)
+        text = f"{stage}：{done}/{total} {PROGRESS_UNITS.get(stage, '')}"
+        elapsed = now - self.stage_start
+        if 0 < done < total and elapsed > 1:
+            text += f"，预计剩余 {format_duration(elapsed / done * (total - done))}"
+        self.status_label.config(text=text)
+
+    def cancel_task(self):
+        """请求取消：后台任务在下一次报告进度时停止"""
+        if self.worker is not None:
+            self.cancel_event.set()
+            self.cancel_button.config(state=tk.DISABLED)
+            self.status_label.config(text="正在取消...")
+
+    def on_close(self):
+        """关闭窗口时先取消正在执行的任务，任务停止后再退出"""
+        if self.worker is None:
+            self.root.destroy()
+            return
+        self.closing = True
+        self.cancel_task()
+
+    def shard_by(self):
+        """勾选了报告分册时返回分册方式，否则返回 None"""
+        return REPORT_SHARD_COLUMN if self.shard_by_team.get() else None
+
+    def shard_note(self, shards):
+        """分册输出时在完成提示中说明分册数量"""
+        if shards:
+            return f"\n（以上为分册目录，共 {len(shards)} 个分册，位于同一文件夹）"
+        return ""
+
+    def profile_note(self, output_path):
+        """勾选了性能剖析时，在完成提示中附上报告路径"""
+        if self.perf_report.get():
+            return f"\n性能剖析报告：\n{output_path}{PROFILE_REPORT_SUFFIX}"
+        return ""
+
     def generate_excel_report(self):
         if not self.excel_path or not self.zip_path:
             messagebox.showerror("错误", "请先选择隐患整改通知单和图片压缩包！")
             return
 
-        try:
-            output_path = os.path.splitext(self.excel_path)[0] + "_带图片.xlsx"
-            errors = embed_images_to_excel(self.excel_path, self.zip_path, output_path)
-
-            # 弹出成功消息
-            msg = f"处理完成！\n输出文件：\n{output_path}"
-            if errors:
-                msg += "\n\n⚠️ 部分图片插入失败，详见下方错误信息。"
-                messagebox.showinfo("处理完成（含警告）", msg)
-                # 弹出错误详情
-                error_text = "\n".join(errors[:20])  # 最多显示20条，避免太长
-                if len(errors) > 20:
-                    error_text += f"\n... 还有 {len(errors) - 20} 条错误未显示"
-                messagebox.showwarning("插入失败详情", error_text)
-            else:
-                messagebox.showinfo("成功", msg)
+        excel_path, zip_path = self.excel_path, self.zip_path
+        output_path = os.path.splitext(excel_path)[0] + "_带图片.xlsx"
+        note = self.profile_note(output_path)
+        incremental = self.incremental.get()
+        # 弹出成功消息
+        self.run_task(lambda progress, profiler: embed_images_to_excel(excel_path, zip_path, output_path, progress=progress,
+                                                                       profiler=profiler, incremental=incremental),
+                      lambda errors: self.show_result(f"处理完成！\n输出文件：\n{output_path}{note}", errors))
 
-        except Exception as e:
-            messagebox.showerror("严重错误", f"程序运行失败：\n{str(e)}")
+    def show_result(self, msg, errors):
+        """弹出处理结果，有图片插入失败时再弹出错误详情"""
+        if errors:
+            msg += "\n\n⚠️ 部分图片插入失败，详见下方错误信息。"
+            messagebox.showinfo("处理完成（含警告）", msg)
+            # 弹出错误详情
+            error_text = "\n".join(errors[:20])  # 最多显示20条，避免太长
+            if len(errors) > 20:
+                error_text += f"\n... 还有 {len(errors) - 20} 条错误未显示"
+            messagebox.showwarning("插入失败详情", error_text)
+        else:
+            messagebox.showinfo("成功", msg)
 
     def generate_check_report(self):
         if not self.excel_path or not self.check_report_template_path or not self.zip_path:
             messagebox.showerror("错误", "请先选择隐患整改通知单、检查报告模板和图片压缩包！")
             return
 
-        try:
-            output_path = os.path.splitext(self.check_report_template_path)[0] + "_检查报告.docx"
-            generate_check_report(self.excel_path, self.check_report_template_path, self.zip_path, output_path)
-            messagebox.showinfo("成功", f"检查报告生成完成！\n输出文件：\n{output_path}")
-
-        except Exception as e:
-            messagebox.showerror("严重错误", f"程序运行失败：\n{str(e)}")
+        excel_path, template_path, zip_path = self.excel_path, self.check_report_template_path, self.zip_path
+        output_path = os.path.splitext(template_path)[0] + "_检查报告.docx"
+        note = self.profile_note(output_path)
+        incremental = self.incremental.get()
+        shard_by = self.shard_by()
+        self.run_task(lambda progress, profiler: generate_check_report(excel_path, template_path, zip_path, output_path,
+                                                                       progress=progress, profiler=profiler,
+                                                                       incremental=incremental, shard_by=shard_by),
+                      lambda shards: messagebox.showinfo("成功", f"检查报告生成完成！\n输出文件：\n{output_path}"
+                                                               f"{self.shard_note(shards)}{note}"))
 
     def generate_closure_report(self):
         if not self.excel_path or not self.closure_report_template_path or not self.zip_path:
             messagebox.showerror("错误", "请先选择隐患整改通知单、闭环报告模板和图片压缩包！")
             return
 
+        excel_path, template_path, zip_path = self.excel_path, self.closure_report_template_path, self.zip_path
+        output_path = os.path.splitext(template_path)[0] + "_闭环报告.docx"
+        note = self.profile_note(output_path)
+        incremental = self.incremental.get()
+        shard_by = self.shard_by()
+        self.run_task(lambda progress, profiler: generate_closure_report(excel_path, template_path, zip_path, output_path,
+                                                                         progress=progress, profiler=profiler,
+                                                                         incremental=incremental, shard_by=shard_by),
+                      lambda shards: messagebox.showinfo("成功", f"闭环报告生成完成！\n输出文件：\n{output_path}"
+                                                               f"{self.shard_note(shards)}{note}"))
+
+    def generate_all(self):
+        if not self.excel_path or not self.check_report_template_path or not self.closure_report_template_path or not self.zip_path:
+            messagebox.showerror("错误", "请先选择隐患整改通知单、检查报告模板、闭环报告模板和图片压缩包！")
+            return
+
+        excel_path, zip_path = self.excel_path, self.zip_path
+        check_template_path, closure_template_path = self.check_report_template_path, self.closure_report_template_path
+        excel_output_path = os.path.splitext(excel_path)[0] + "_带图片.xlsx"
+        check_output_path = os.path.splitext(check_template_path)[0] + "_检查报告.docx"
+        closure_output_path = os.path.splitext(closure_template_path)[0] + "_闭环报告.docx"
+        note = self.profile_note(excel_output_path)
+        incremental = self.incremental.get()
+        shard_by = self.shard_by()
+        if shard_by is not None:
+            note = "\n（报告已按班组分册，以上报告文件为分册目录）" + note
+        self.run_task(lambda progress, profiler: generate_all(excel_path, zip_path, check_template_path, closure_template_path,
+                                                              excel_output_path, check_output_path, closure_output_path,
+                                                              progress=progress, profiler=profiler, incremental=incremental,
+                                                              shard_by=shard_by),
+                      lambda errors: self.show_result(f"全部生成完成！\n输出文件：\n{excel_output_path}\n{check_output_path}\n{closure_output_path}{note}", errors))
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="隐患整改台账与报告生成工具，不带参数运行时启动图形界面")
+    subparsers = parser.add_subparsers(dest="command")
+
+    batch = subparsers.add_parser("batch", help="批量处理多个台账和图片压缩包（无需图形界面）")
+    source = batch.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="作业目录，每个子目录包含一个台账 .xlsx 和一个图片压缩包 .zip")
+    source.add_argument("--manifest", help="JSON 作业清单")
+    batch.add_argument("--out", required=True, help="输出目录，每个作业的结果写入以作业名命名的子目录")
+    batch.add_argument("--check-template", help="检查报告模板（.docx），省略则不生成检查报告")
+    batch.add_argument("--closure-template", help="闭环报告模板（.docx），省略则不生成闭环报告")
+    batch.add_argument("--jobs", type=int, help="同时处理的作业数，默认等于 CPU 核心数")
+    batch.add_argument("--workers", type=int, help="每个作业的图片转码进程数")
+    batch.add_argument("--profile", choices=sorted(OUTPUT_PROFILES), help="输出档位")
+    batch.add_argument("--resample", choices=RESAMPLE_MODES, help="缩放模式")
+    batch.add_argument("--target-mb", type=float, help="单个输出文件的大小上限（MB）")
+    batch.add_argument("--no-cache", action="store_true", help="不使用缩略图磁盘缓存")
+    batch.add_argument("--streaming", action="store_true", default=None, help="流式写出台账，内存占用与台账行数无关")
+    shard = batch.add_mutually_exclusive_group()
+    shard.add_argument("--shard-by-team", dest="shard_by", action="store_const", const=REPORT_SHARD_COLUMN,
+                       help="报告按班组分册，每个班组一份文件，报告输出路径处为分册目录")
+    shard.add_argument("--shard-size", dest="shard_by", type=int, metavar="N", help="报告每若干条隐患分为一册")
+    batch.add_argument("--incremental", action="store_true", default=None,
+                       help=f"增量生成：复用上次输出中未变化的图片，台账和图片都未变化时跳过（清单写在输出文件旁的 *{MANIFEST_SUFFIX}）")
+    batch.add_argument("--perf-report", action="store_true",
+                       help=f"记录各阶段耗时、最慢图片和内存采样，写入台账输出文件旁的 *{PROFILE_REPORT_SUFFIX}")
+
+    serve = subparsers.add_parser("serve", help="启动本机常驻作业服务，连续生成时复用模板、压缩包索引、转码结果和转码进程")
+    serve.add_argument("--port", type=int, default=SERVER_PORT, help=f"监听端口（只监听 {SERVER_HOST}），默认 {SERVER_PORT}")
+    serve.add_argument("--photo-cache-mb", type=int, default=WARM_PHOTO_CACHE_MAX_BYTES // 1024 // 1024,
+                       help="内存缩略图缓存上限（MB）")
+
+    submit = subparsers.add_parser("submit", help="向本机作业服务提交作业并等待完成")
+    submit.add_argument("spec", help="JSON 作业说明（单个对象或列表），字段见 run_server_job")
+    submit.add_argument("--port", type=int, default=SERVER_PORT, help=f"服务端口，默认 {SERVER_PORT}")
+    submit.add_argument("--no-wait", action="store_true", help="只提交，不等待作业结束")
+    return parser
+
+def submit_jobs(spec_path, port=SERVER_PORT, wait=True):
+    """命令行 submit：逐个提交作业并打印进度和结果，有作业失败或取消时返回 1"""
+    failed = False
+    for spec in load_job_specs(spec_path):
+        def progress(stage, done, total):
+            print(f"  {stage}：{done}/{total} {PROGRESS_UNITS.get(stage, '')}", flush=True)
+
+        job = submit_job(spec, port, wait, progress)
+        line = f"[{job['status']}] 作业 {job['id']}（{job['kind']}）  {job['seconds']:.1f}s"
+        if job["errors"]:
+            line += f"  图片错误 {len(job['errors'])} 条"
+        if job.get("message"):
+            line += f"  {job['message']}"
+        print(line, flush=True)
+        failed = failed or job["status"] in ("failed", "cancelled")
+    return 1 if failed else 0
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+
+    if args.command == "batch":
         try:
-            output_path = os.path.splitext(self.closure_report_template_path)[0] + "_闭环报告.docx"
-            generate_closure_report(self.excel_path, self.closure_report_template_path, self.zip_path, output_path)
-            messagebox.showinfo("成功", f"闭环报告生成完成！\n输出文件：\n{output_path}")
+            jobs = discover_batch_jobs(args.dir) if args.dir else load_batch_manifest(args.manifest)
+        except (OSError, ValueError) as e:
+            print(f"无法读取作业{'目录' if args.dir else '清单'}：{e}", file=sys.stderr)
+            return 1
+        options = {
+            "check_template": args.check_template,
+            "closure_template": args.closure_template,
+            "workers": args.workers,
+            "cache": False if args.no_cache else None,
+            "resample": args.resample,
+            "profile": args.profile,
+            "target_mb": args.target_mb,
+            "streaming": args.streaming,
+            "incremental": args.incremental,
+            "shard_by": args.shard_by,
+            "perf_report": args.perf_report,
+        }
+        results = run_batch(jobs, args.out, options, args.jobs)
+        return 1 if any(r["status"] == "failed" for r in results) else 0
 
-        except Exception as e:
-            messagebox.showerror("严重错误", f"程序运行失败：\n{str(e)}")
+    if args.command == "serve":
+        server = JobServer(args.port, enable_warm_caches(photo_bytes=args.photo_cache_mb * 1024 * 1024))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
 
-if __name__ == "__main__":
+    if args.command == "submit":
+        try:
+            return submit_jobs(args.spec, args.port, not args.no_wait)
+        except OSError as e:
+            print(f"无法连接作业服务（先运行 serve 子命令）：{e}", file=sys.stderr)
+            return 1
+        except RuntimeError as e:
+            print(f"作业服务拒绝了请求：{e}", file=sys.stderr)
+            return 1
+
+    # 图形界面进程在多次点击之间保留转码结果；不缓存压缩包索引（避免压缩包一直被占用）、不保留空闲的转码进程
+    enable_warm_caches(zip_indexes=0, keep_pool=False)
+    _import_tkinter()
     root = tk.Tk()
     app = App(root)
     root.mainloop()
+    return 0
+
+if __name__ == "__main__":
+    # 打包为可执行文件时，转码进程池需要此调用
+    multiprocessing.freeze_support()
+    sys.exit(main())